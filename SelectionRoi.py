@@ -30,6 +30,7 @@ from PyQt5.QtCore import (
 from PyQt5.QtGui import (
     QColor,
     QPainterPath,
+    QPainterPathStroker,
     QPen,
     QIcon,
     QPixmap,
@@ -156,6 +157,7 @@ class SelectionRoi(QAbstractGraphicsShapeItem):
         self.setEnabled(True)
         self.setFlag(QGraphicsItem.ItemIsSelectable)
         self.setFlag(QGraphicsItem.ItemIsMovable)
+        self.setFlag(QGraphicsItem.ItemSendsGeometryChanges)
         # create anchors as graphics children to this ROI
         self.anchors = [Anchor(x, self) for x in self.get_anchor_types()]
         self.hide_anchors()
@@ -163,6 +165,12 @@ class SelectionRoi(QAbstractGraphicsShapeItem):
         self.base_line_width = 1.0
         self.base_anchor_size = 4.0
         self.color_rgb = [0, 0, 0]
+        # tracking through a stack: (frames, 2) offsets (dy, dx) from the position tracking_origin, the frame
+        # the ROI is at, and whether it is being moved to a frame (see move_to_frame)
+        self.frame_offsets = None
+        self.tracking_origin = None
+        self.tracking_frame = 0
+        self.is_moving_to_frame = False
 
     def set_properties(self, color_rgb: str = [0, 0, 0], line_width: float = 1.0, anchor_size: float = 4.0):
         """ Set properties: color, line width, anchor size
@@ -246,6 +254,71 @@ class SelectionRoi(QAbstractGraphicsShapeItem):
         bp = path.pointAtPercent(percent)
         return ((bp.x() - point.x())**2.0 + (bp.y() - point.y())**2.0)**0.5
 
+    # ------------------------------------------------
+    # geometry change notification
+    # ------------------------------------------------
+
+    def itemChange(self, change: QGraphicsItem.GraphicsItemChange, value):
+        """ Notify the scene when the ROI is moved, other than by tracking (see move_to_frame).
+            Moving a tracked ROI (e.g. dragging it) moves its whole track.
+            Overrides QGraphicsItem::itemChange.
+        """
+        if change == QGraphicsItem.ItemPositionHasChanged and not self.is_moving_to_frame:
+            if self.frame_offsets is not None:
+                dy, dx = self.frame_offsets[self.tracking_frame]
+                self.tracking_origin = self.pos() - QPointF(dx, dy)
+            self.geometry_changed()
+        return super().itemChange(change, value)
+
+    def geometry_changed(self):
+        """ Tell the scene (if it has a roi_geometry_changed signal) that the ROI shape or position has changed.
+        """
+        scene = self.scene()
+        if scene is not None and hasattr(scene, 'roi_geometry_changed'):
+            scene.roi_geometry_changed.emit(self)
+
+    # ------------------------------------------------
+    # tracking
+    # ------------------------------------------------
+
+    def set_tracking(self, frame_offsets: np.ndarray, frame: int = 0):
+        """ Set the per-frame offsets of the ROI (e.g. from tracking).
+        @param frame_offsets: (frames, 2) offsets (dy, dx)
+        @param frame: frame that the ROI is at now
+        """
+        self.frame_offsets = np.asarray(frame_offsets)
+        self.tracking_frame = frame
+        dy, dx = self.frame_offsets[frame]
+        self.tracking_origin = self.pos() - QPointF(dx, dy)
+        self.geometry_changed()
+
+    def clear_tracking(self):
+        """ Drop the per-frame offsets; the ROI stays where it is.
+        """
+        if self.frame_offsets is not None:
+            self.frame_offsets = None
+            self.tracking_origin = None
+            self.geometry_changed()
+
+    def move_to_frame(self, frame: int):
+        """ Move a tracked ROI to its position in a frame.
+            The scene is not notified: the ROI's track, which measurements use (see tracking_region), is unchanged.
+        """
+        if self.frame_offsets is not None and 0 <= frame < len(self.frame_offsets):
+            dy, dx = self.frame_offsets[frame]
+            self.tracking_frame = frame
+            self.is_moving_to_frame = True
+            self.setPos(self.tracking_origin + QPointF(dx, dy))
+            self.is_moving_to_frame = False
+
+    def tracking_region(self) -> QPainterPath:
+        """ Area enclosed by the ROI, in scene coordinates, at its tracking origin (i.e. with frame offset 0),
+            or where it is if it is not tracked.
+        """
+        if self.frame_offsets is None:
+            return self.scene_region()
+        return self.scene_region().translated(self.tracking_origin - self.pos())
+
     # ------------------------------------------------
     # ROI adjustment: methods to overridden by concrete classes.
     # ------------------------------------------------
@@ -271,6 +344,17 @@ class SelectionRoi(QAbstractGraphicsShapeItem):
         """
         pass
 
+    @abstractmethod
+    def region(self) -> QPainterPath:
+        """ Area enclosed by the ROI, in item coordinates (excludes the pen width).
+        """
+        pass
+
+    def scene_region(self) -> QPainterPath:
+        """ Area enclosed by the ROI, in scene (image) coordinates.
+        """
+        return self.mapToScene(self.region())
+
 
 # ------------------------------------------------
 # concrete ROI classes
@@ -295,6 +379,11 @@ class PointRoi(QGraphicsEllipseItem, SelectionRoi):
     def adjust_anchors(self):
         pass
 
+    def region(self) -> QPainterPath:
+        path = QPainterPath()
+        path.addEllipse(self.rect())
+        return path
+
 
 class PathRoi(QGraphicsPathItem, SelectionRoi):
     """ Path ROI. Includes single line (two-element coordinate list) and polygons (is_close = True).
@@ -343,6 +432,7 @@ class PathRoi(QGraphicsPathItem, SelectionRoi):
 
         self.setPath(path)
         self.adjust_anchors()
+        self.geometry_changed()
 
     def adjust_anchors(self):
         path = self.path()
@@ -351,6 +441,23 @@ class PathRoi(QGraphicsPathItem, SelectionRoi):
             off = point.boundingRect().width() / 2
             point.setPos(path_element.x - off, path_element.y - off)
 
+    def region(self) -> QPainterPath:
+        # open paths cover the pixels along a one-pixel wide line
+        if self.is_closed:
+            return self.path()
+        stroker = QPainterPathStroker()
+        stroker.setWidth(1.0)
+        return stroker.createStroke(self.path())
+
+    def scene_points(self) -> tuple:
+        """ Path vertices in scene (image) coordinates.
+        @return: lists of x and y coordinates.
+        """
+        path = self.mapToScene(self.path())
+        x = [path.elementAt(i).x for i in range(path.elementCount())]
+        y = [path.elementAt(i).y for i in range(path.elementCount())]
+        return x, y
+
 
 class ShapeRoi(SelectionRoi):
     """  Base class for Rectangle and Ellipse ROI.
@@ -397,6 +504,7 @@ class ShapeRoi(SelectionRoi):
             rect.setBottom(rect.bottom() + mouse.y())
         self.setRect(rect.normalized())
         self.adjust_anchors()
+        self.geometry_changed()
 
     def adjust_anchors(self):
         bounds = self.boundingRect()
@@ -427,6 +535,11 @@ class RectangleRoi(QGraphicsRectItem, ShapeRoi):
     def __init__(self, x0: int, y0: int, width: int, height: int):
         super(RectangleRoi, self).__init__(x0, y0, width, height)
 
+    def region(self) -> QPainterPath:
+        path = QPainterPath()
+        path.addRect(self.rect())
+        return path
+
 
 class EllipseRoi(QGraphicsEllipseItem, ShapeRoi):
     """ Ellipse ROI.
@@ -435,3 +548,8 @@ class EllipseRoi(QGraphicsEllipseItem, ShapeRoi):
     def __init__(self, x0: int, y0: int, width: int, height: int):
         super(EllipseRoi, self).__init__(x0, y0, width, height)
 
+    def region(self) -> QPainterPath:
+        path = QPainterPath()
+        path.addEllipse(self.rect())
+        return path
+
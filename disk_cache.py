@@ -0,0 +1,116 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# On-disk cache of data derived from image files (e.g. TIFF page indices), keyed by file identity.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# cache directory, in the user's cache folder
+CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'image_viewer')
+# total size of the cache (bytes), beyond which the least recently used entries are removed
+CACHE_SIZE_LIMIT = 2 << 30
+# number of entries written between checks of the cache size (a check lists the whole cache)
+TRIM_INTERVAL = 64
+_saves_since_trim = TRIM_INTERVAL
+_trim_lock = threading.Lock()
+# writer of entries saved in the background (see save_array_later)
+_writer = ThreadPoolExecutor(1)
+
+
+def file_key(path: str, *settings) -> str:
+    """ Key of a file's identity (path, size and modification time) and of any settings that derived
+        data depends on. The key changes when the file is modified.
+    @param path: file
+    @param settings: further values (with reproducible str()) that the derived data depends on
+    @return: hex digest
+    """
+    status = os.stat(path)
+    identity = [os.path.abspath(path), status.st_size, status.st_mtime_ns] + list(settings)
+    return hashlib.sha1('|'.join(str(x) for x in identity).encode()).hexdigest()
+
+
+def cache_path(kind: str, key: str, suffix: str = '.npy') -> str:
+    """ Path of a cache entry.
+    @param kind: kind of entry (a subdirectory of the cache directory)
+    @param key: entry key, e.g. from file_key
+    @param suffix: file name suffix
+    """
+    return os.path.join(CACHE_DIRECTORY, kind, key + suffix)
+
+
+def load_array(kind: str, key: str) -> np.ndarray:
+    """ Cached array, or None if there is none (or it can't be read).
+        Reading an entry marks it as recently used.
+    """
+    path = cache_path(kind, key)
+    try:
+        array = np.load(path)
+        os.utime(path)
+        return array
+    except (OSError, ValueError):
+        return None
+
+
+def save_array(kind: str, key: str, array: np.ndarray):
+    """ Cache an array. The cache is an optimization, so failure to write it (e.g. no disk space) is ignored.
+    """
+    global _saves_since_trim
+    path = cache_path(kind, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so a concurrent reader never sees a partial file
+        temporary = path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+        with open(temporary, 'wb') as file:
+            np.save(file, array)
+        os.replace(temporary, path)
+    except OSError:
+        return
+    # entries are saved from worker threads
+    with _trim_lock:
+        _saves_since_trim += 1
+        is_trim_due = _saves_since_trim >= TRIM_INTERVAL
+        if is_trim_due:
+            _saves_since_trim = 0
+    if is_trim_due:
+        trim()
+
+
+def save_array_later(kind: str, key: str, array: np.ndarray):
+    """ Cache an array on a background thread, e.g. from the GUI thread, so that painting doesn't wait for the
+        disk (or for a trim of the cache). The array must not be modified afterwards.
+    """
+    _writer.submit(save_array, kind, key, array)
+
+
+def trim(size_limit: int = None):
+    """ Remove the least recently used entries (by modification time, which reading an entry updates)
+        until the cache is within its size limit.
+    @param size_limit: size limit (bytes), None for CACHE_SIZE_LIMIT.
+    """
+    size_limit = CACHE_SIZE_LIMIT if size_limit is None else size_limit
+    entries = []
+    for directory, _, names in os.walk(CACHE_DIRECTORY):
+        for name in names:
+            try:
+                status = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((status.st_mtime_ns, status.st_size, os.path.join(directory, name)))
+    total = sum(x[1] for x in entries)
+    for _, size, path in sorted(entries):
+        if total <= size_limit:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
@@ -0,0 +1,516 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Numpy image analysis used by the image viewer: gray values of RGB data, intensity percentiles, thresholding,
+# object detection, label statistics, line profiles, kymographs and stack projections.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# ------------------------------------------------
+# Gray values
+# ------------------------------------------------
+
+
+def rgb_to_gray(rgb: np.ndarray) -> np.ndarray:
+    """ Gray values of RGB pixels, weighted as by Qt's conversion to grayscale (qGray), so RGB data measure
+        the same as RGB image files, whose data are their grayscale images.
+    @param rgb: (..., 3) array
+    @return: (...) array of the same type
+    """
+    weights = np.array([11, 16, 5])
+    if np.issubdtype(rgb.dtype, np.integer):
+        return (np.asarray(rgb, dtype=np.int64) @ weights // 32).astype(rgb.dtype)
+    return (np.asarray(rgb) @ weights.astype(rgb.dtype) / 32).astype(rgb.dtype)
+
+
+# ------------------------------------------------
+# Intensity percentiles
+# ------------------------------------------------
+
+
+def sample_values(array: np.ndarray, top: int = 0, bottom: int = None, left: int = 0, right: int = None,
+                  max_samples: int = 1 << 18) -> np.ndarray:
+    """ Values of a region of an image, sampled on a regular grid of at most about max_samples pixels.
+    @return: 1D array of values
+    """
+    bottom = array.shape[0] if bottom is None else bottom
+    right = array.shape[1] if right is None else right
+    step = max(1, int(np.ceil(np.sqrt((bottom - top) * (right - left) / max_samples))))
+    return np.asarray(array[top:bottom:step, left:right:step]).ravel()
+
+
+def histogram_percentiles(values: np.ndarray, percents: list, n_bins: int = 4096) -> list:
+    """ Percentiles of values, from their histogram rather than a sort.
+        Integer values of up to 16 bits are counted exactly (so the percentiles are exact); other values are
+        binned between their minimum and maximum, and interpolated within a bin.
+    @param values: values
+    @param percents: percentiles to find (0 to 100)
+    @param n_bins: number of histogram bins for non-integer values
+    @return: percentile values
+    """
+    if values.dtype.kind in 'ui' and values.dtype.itemsize <= 2:
+        if len(values) == 0:
+            return [0.0] * len(percents)
+        offset = int(values.min())
+        cumulative = np.cumsum(np.bincount((values.astype(np.int64) - offset)))
+        return [float(offset + np.searchsorted(cumulative, x / 100 * cumulative[-1])) for x in percents]
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return [0.0] * len(percents)
+    low, high = float(values.min()), float(values.max())
+    if high <= low:
+        return [low] * len(percents)
+    counts, edges = np.histogram(values, bins=n_bins, range=(low, high))
+    cumulative = np.cumsum(counts)
+    result = []
+    for x in percents:
+        target = x / 100 * cumulative[-1]
+        i = min(int(np.searchsorted(cumulative, target)), n_bins - 1)
+        before = cumulative[i - 1] if i > 0 else 0
+        fraction = (target - before) / counts[i] if counts[i] else 0.0
+        result.append(float(edges[i] + fraction * (edges[i + 1] - edges[i])))
+    return result
+
+
+# ------------------------------------------------
+# Thresholding
+# ------------------------------------------------
+
+
+def otsu_threshold(array: np.ndarray, n_bins: int = 256) -> float:
+    """ Otsu threshold of an image, from its histogram.
+    @param array: image
+    @param n_bins: number of histogram bins
+    @return: threshold; pixels > threshold are foreground.
+    """
+    low, high = float(np.min(array)), float(np.max(array))
+    if high <= low:
+        return low
+    counts, edges = np.histogram(array, bins=n_bins, range=(low, high))
+    centers = (edges[:-1] + edges[1:]) / 2
+    # class weights and means for every possible split
+    weight_0 = np.cumsum(counts)
+    weight_1 = weight_0[-1] - weight_0
+    sum_0 = np.cumsum(counts * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_0 = sum_0 / weight_0
+        mean_1 = (sum_0[-1] - sum_0) / weight_1
+        between = weight_0 * weight_1 * (mean_0 - mean_1)**2
+    between[~np.isfinite(between)] = 0
+    return float(edges[np.argmax(between) + 1])
+
+
+# ------------------------------------------------
+# Connected components
+#
+# Foreground is represented as horizontal runs: (row, start, end) with end exclusive.
+# Runs are extracted from row-bands in parallel, runs on adjacent rows that touch are joined into
+# components by vectorized label propagation, and component properties (area, moments, bounding box)
+# are accumulated from the runs without ever building a label image.
+# ------------------------------------------------
+
+
+def foreground_runs(mask: np.ndarray, row_offset: int = 0) -> tuple:
+    """ Horizontal runs of True pixels in a mask.
+    @param mask: 2D boolean mask
+    @param row_offset: added to the run rows (for masks that are a band of a larger image)
+    @return: rows, starts and (exclusive) ends of runs, ordered by row then start.
+    """
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    steps = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(steps == 1)
+    ends = np.nonzero(steps == -1)[1]
+    return rows + row_offset, starts, ends
+
+
+def label_runs(rows: np.ndarray, starts: np.ndarray, ends: np.ndarray, width: int,
+               connectivity: int = 8) -> np.ndarray:
+    """ Label the connected components formed by a set of runs.
+    @param rows: run rows
+    @param starts: run starts
+    @param ends: run (exclusive) ends
+    @param width: width of the image
+    @param connectivity: 4 or 8
+    @return: component label of each run, 0 ... number of components - 1.
+    """
+    n_runs = len(rows)
+    if n_runs == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # row-major keys - sorted, as runs are ordered by row and do not overlap within a row.
+    key_width = width + 2
+    start_keys = rows * key_width + starts
+    end_keys = rows * key_width + ends
+    # runs in the next row that touch each run are a contiguous range [lo, hi)
+    reach = 1 if connectivity == 8 else 0
+    next_row = (rows + 1) * key_width
+    lo = np.searchsorted(end_keys, next_row + starts - reach, side='right')
+    hi = np.searchsorted(start_keys, next_row + ends + reach, side='left')
+    counts = np.maximum(hi - lo, 0)
+    # expand ranges to pairs of touching runs
+    first = np.repeat(np.arange(n_runs), counts)
+    second = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+
+    # min-label propagation with pointer jumping
+    labels = np.arange(n_runs)
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, first, labels[second])
+        np.minimum.at(labels, second, labels[first])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            break
+
+    return np.unique(labels, return_inverse=True)[1]
+
+
+class ObjectTable:
+    """ Connected components of a thresholded image, held as runs with per-component properties.
+        Pixel (x, y) covers [x, x+1) x [y, y+1), so centroids are in continuous image coordinates.
+    """
+
+    def __init__(self, rows: np.ndarray, starts: np.ndarray, ends: np.ndarray, labels: np.ndarray):
+        """
+        @param rows: run rows
+        @param starts: run starts
+        @param ends: run (exclusive) ends
+        @param labels: component label of each run
+        """
+        self.rows = rows
+        self.starts = starts
+        self.ends = ends
+        self.labels = labels
+        self.n_objects = int(labels.max()) + 1 if len(labels) else 0
+
+        # moments from closed-form sums over each run
+        lengths = (ends - starts).astype(np.float64)
+        y = rows + 0.5
+        sum_x = lengths * (starts + ends) / 2
+        sum_xx = (ends**3 - starts**3) / 3
+        self.area = np.bincount(labels, lengths, minlength=self.n_objects)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.centroid_x = np.bincount(labels, sum_x, minlength=self.n_objects) / self.area
+            self.centroid_y = np.bincount(labels, y * lengths, minlength=self.n_objects) / self.area
+            self.variance_x = np.bincount(labels, sum_xx, minlength=self.n_objects) / self.area - self.centroid_x**2
+            self.variance_y = (np.bincount(labels, y**2 * lengths, minlength=self.n_objects) / self.area
+                               - self.centroid_y**2 + 1 / 12)
+
+        # bounding boxes
+        self.left = np.full(self.n_objects, np.iinfo(np.int64).max)
+        self.right = np.zeros(self.n_objects, dtype=np.int64)
+        self.top = np.full(self.n_objects, np.iinfo(np.int64).max)
+        self.bottom = np.zeros(self.n_objects, dtype=np.int64)
+        np.minimum.at(self.left, labels, starts)
+        np.maximum.at(self.right, labels, ends)
+        np.minimum.at(self.top, labels, rows)
+        np.maximum.at(self.bottom, labels, rows + 1)
+
+    def select(self, keep: np.ndarray) -> 'ObjectTable':
+        """ Table of a subset of objects.
+        @param keep: boolean mask over objects
+        @return: new table, with objects relabelled.
+        """
+        new_labels = np.cumsum(keep) - 1
+        in_run = keep[self.labels]
+        return ObjectTable(self.rows[in_run], self.starts[in_run], self.ends[in_run], new_labels[self.labels[in_run]])
+
+    def ellipse_fits(self) -> np.ndarray:
+        """ Axis-aligned ellipses with the same second moments as each object.
+        @return: (n_objects, 4) array of x0, y0, width, height.
+        """
+        # a uniform ellipse with semi-axis a has variance a^2 / 4
+        width = 4 * np.sqrt(np.maximum(self.variance_x, 0))
+        height = 4 * np.sqrt(np.maximum(self.variance_y, 0))
+        return np.column_stack([self.centroid_x - width / 2, self.centroid_y - height / 2, width, height])
+
+    def outlines(self) -> list:
+        """ Row-wise outline of each object: the left-most and right-most edges of each row,
+            traced down the left side and back up the right side.
+        @return: list of (x, y) coordinate array pairs, one per object.
+        """
+        if self.n_objects == 0:
+            return []
+        # extent of each (object, row)
+        order = np.lexsort((self.rows, self.labels))
+        labels, rows = self.labels[order], self.rows[order]
+        group_start = np.flatnonzero(np.r_[True, (np.diff(labels) != 0) | (np.diff(rows) != 0)])
+        left = np.minimum.reduceat(self.starts[order], group_start)
+        right = np.maximum.reduceat(self.ends[order], group_start)
+        rows = rows[group_start] + 0.5
+        # split into objects
+        splits = np.flatnonzero(np.diff(labels[group_start])) + 1
+        outlines = []
+        for l, r, y in zip(np.split(left, splits), np.split(right, splits), np.split(rows, splits)):
+            outlines.append((np.concatenate([l, r[::-1]]), np.concatenate([y, y[::-1]])))
+        return outlines
+
+
+def detect_objects(array: np.ndarray, threshold: float = None, min_area: float = 1, max_area: float = None,
+                   connectivity: int = 8, band_rows: int = 512, n_threads: int = None) -> ObjectTable:
+    """ Threshold an image and find its connected components.
+        Thresholding and run extraction are done on row-bands in a thread pool.
+    @param array: 2D image
+    @param threshold: pixels > threshold are foreground. If None, Otsu's threshold is used.
+    @param min_area: smallest object area to keep (pixels)
+    @param max_area: largest object area to keep (pixels), None for no limit.
+    @param connectivity: 4 or 8
+    @param band_rows: rows per band
+    @param n_threads: thread pool size, None for the number of CPUs.
+    @return: table of objects.
+    """
+    if threshold is None:
+        threshold = otsu_threshold(array[::max(1, array.shape[0] // 1024), ::max(1, array.shape[1] // 1024)])
+
+    # runs from each band
+    bands = range(0, array.shape[0], band_rows)
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as pool:
+        band_runs = list(pool.map(lambda r: foreground_runs(array[r:r + band_rows] > threshold, r), bands))
+    rows, starts, ends = [np.concatenate(x) for x in zip(*band_runs)]
+
+    # components, filtered by area
+    labels = label_runs(rows, starts, ends, array.shape[1], connectivity)
+    table = ObjectTable(rows, starts, ends, labels)
+    keep = table.area >= min_area
+    if max_area is not None:
+        keep &= table.area <= max_area
+    return table.select(keep)
+
+
+# ------------------------------------------------
+# Label images
+# ------------------------------------------------
+
+
+class LabelStatistics:
+    """ Area, mean intensity and bounding box of each label of a label image (label 0 is background).
+        Area and intensity sums are a single bincount over the pixels; bounding boxes are reduced over the
+        horizontal runs of each label rather than over every pixel.
+    """
+
+    def __init__(self, labels: np.ndarray, intensity: np.ndarray = None):
+        """
+        @param labels: (height, width) integer label image
+        @param intensity: (height, width) intensity image, for mean intensities.
+        """
+        flat = labels.ravel()
+        self.area = np.bincount(flat)
+        self.n_labels = len(self.area)
+        self.mean = None
+        if intensity is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.mean = np.bincount(flat, intensity.ravel().astype(np.float64), self.n_labels) / self.area
+
+        # runs of constant label: start where the label differs from the pixel to its left
+        is_start = np.ones(labels.shape, dtype=bool)
+        is_start[:, 1:] = labels[:, 1:] != labels[:, :-1]
+        rows, starts = np.nonzero(is_start)
+        run_labels = labels[rows, starts]
+        ends = np.append(starts[1:], 0)
+        ends[np.append(rows[1:] != rows[:-1], True)] = labels.shape[1]
+        # bounding boxes (exclusive right and bottom); empty labels have left > right
+        self.left = np.full(self.n_labels, labels.shape[1])
+        self.right = np.zeros(self.n_labels, dtype=np.int64)
+        self.top = np.full(self.n_labels, labels.shape[0])
+        self.bottom = np.zeros(self.n_labels, dtype=np.int64)
+        np.minimum.at(self.left, run_labels, starts)
+        np.maximum.at(self.right, run_labels, ends)
+        np.minimum.at(self.top, run_labels, rows)
+        np.maximum.at(self.bottom, run_labels, rows + 1)
+
+
+# ------------------------------------------------
+# Line sampling
+#
+# Coordinates are continuous image coordinates: the centre of pixel (i, j) is at (j + 0.5, i + 0.5).
+# ------------------------------------------------
+
+
+def bilinear_sample(array: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """ Bilinear interpolation of an image at (sub-pixel) points.
+        Points beyond the outermost pixel centres take the edge values.
+    @param array: image, sampled on its last two axes (so a stack of frames can be sampled at once).
+    @param x: x coordinates
+    @param y: y coordinates (same shape as x)
+    @return: values, with shape array.shape[:-2] + x.shape
+    """
+    height, width = array.shape[-2:]
+    fx = np.clip(np.asarray(x, dtype=np.float64) - 0.5, 0, width - 1)
+    fy = np.clip(np.asarray(y, dtype=np.float64) - 0.5, 0, height - 1)
+    x0 = np.minimum(fx.astype(np.intp), max(width - 2, 0))
+    y0 = np.minimum(fy.astype(np.intp), max(height - 2, 0))
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    wx = fx - x0
+    wy = fy - y0
+    top = array[..., y0, x0] * (1 - wx) + array[..., y0, x1] * wx
+    bottom = array[..., y1, x0] * (1 - wx) + array[..., y1, x1] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def line_sample_points(x: list, y: list, step: float = 0.5, width: float = 1.0) -> tuple:
+    """ Sample points along a polyline, with perpendicular offsets for averaging over a width.
+    @param x: polyline vertex x coordinates
+    @param y: polyline vertex y coordinates
+    @param step: distance between samples along the line (pixels)
+    @param width: width of the line (pixels); rounded to a whole number of perpendicular samples.
+    @return: distance of each sample along the line, and (n_samples, n_perpendicular) arrays of x and y.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    segment_x = np.diff(x)
+    segment_y = np.diff(y)
+    segment_length = np.hypot(segment_x, segment_y)
+    vertex_distance = np.concatenate([[0], np.cumsum(segment_length)])
+    # samples along the line
+    distance = np.arange(0, vertex_distance[-1] + step / 2, step)
+    segment = np.clip(np.searchsorted(vertex_distance, distance, side='right') - 1, 0, len(segment_length) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.nan_to_num((distance - vertex_distance[segment]) / segment_length[segment])
+        unit_x = np.nan_to_num(segment_x / segment_length)[segment]
+        unit_y = np.nan_to_num(segment_y / segment_length)[segment]
+    centre_x = x[segment] + fraction * segment_x[segment]
+    centre_y = y[segment] + fraction * segment_y[segment]
+    # perpendicular offsets
+    n_across = max(1, int(round(width)))
+    offset = np.arange(n_across) - (n_across - 1) / 2
+    sample_x = centre_x[:, None] - unit_y[:, None] * offset[None, :]
+    sample_y = centre_y[:, None] + unit_x[:, None] * offset[None, :]
+    return distance, sample_x, sample_y
+
+
+def line_profile(array: np.ndarray, x: list, y: list, step: float = 0.5, width: float = 1.0) -> tuple:
+    """ Intensity profile along a polyline.
+    @param array: 2D image
+    @param x: polyline vertex x coordinates
+    @param y: polyline vertex y coordinates
+    @param step: distance between samples along the line (pixels)
+    @param width: width of the line (pixels), averaged across.
+    @return: distance along the line and profile values.
+    """
+    distance, sample_x, sample_y = line_sample_points(x, y, step, width)
+    return distance, bilinear_sample(array, sample_x, sample_y).mean(axis=-1)
+
+
+def kymograph(stack: np.ndarray, x: list, y: list, step: float = 1.0, width: float = 1.0,
+              chunk_frames: int = 64) -> np.ndarray:
+    """ Profile along a polyline for every frame of a stack.
+        The sample points are computed once, and frames are gathered in chunks, so a memory-mapped
+        stack is only read at the pixels under the line.
+    @param stack: (frames, height, width) stack, e.g. a numpy memmap.
+    @param x: polyline vertex x coordinates
+    @param y: polyline vertex y coordinates
+    @param step: distance between samples along the line (pixels)
+    @param width: width of the line (pixels), averaged across.
+    @param chunk_frames: number of frames gathered at once
+    @return: (frames, samples) array - time down, distance across.
+    """
+    distance, sample_x, sample_y = line_sample_points(x, y, step, width)
+    result = np.empty((stack.shape[0], len(distance)), dtype=np.float32)
+    for start in range(0, stack.shape[0], chunk_frames):
+        chunk = stack[start:start + chunk_frames]
+        result[start:start + len(chunk)] = bilinear_sample(chunk, sample_x, sample_y).mean(axis=-1)
+    return result
+
+
+# ------------------------------------------------
+# Stack projections
+# ------------------------------------------------
+
+
+def _project_band(stack: np.ndarray, top: int, bottom: int, method: str, chunk_frames: int, step) -> np.ndarray:
+    """ Projection of a row-band of a stack, streaming chunks of frames through running accumulators.
+    @param step: called after each chunk; returns False to stop.
+    @return: projection of the band, or None if stopped.
+    """
+    n_frames = stack.shape[0]
+    if method == 'median':
+        # exact median needs the whole band (the band height is limited by the caller)
+        values = np.empty((n_frames, bottom - top) + stack.shape[2:], dtype=stack.dtype)
+        for start in range(0, n_frames, chunk_frames):
+            values[start:start + chunk_frames] = stack[start:start + chunk_frames, top:bottom]
+            if not step():
+                return None
+        return np.median(values, axis=0)
+
+    result = None
+    mean = None
+    m2 = None
+    count = 0
+    for start in range(0, n_frames, chunk_frames):
+        chunk = np.asarray(stack[start:start + chunk_frames, top:bottom])
+        if method == 'max':
+            chunk_max = chunk.max(axis=0)
+            result = chunk_max if result is None else np.maximum(result, chunk_max)
+        elif method == 'min':
+            chunk_min = chunk.min(axis=0)
+            result = chunk_min if result is None else np.minimum(result, chunk_min)
+        else:
+            # Welford / Chan: merge the chunk mean and sum of squared deviations into the running ones
+            chunk = chunk.astype(np.float64)
+            chunk_count = chunk.shape[0]
+            chunk_mean = chunk.mean(axis=0)
+            chunk_m2 = ((chunk - chunk_mean)**2).sum(axis=0)
+            if mean is None:
+                mean, m2 = chunk_mean, chunk_m2
+            else:
+                delta = chunk_mean - mean
+                total = count + chunk_count
+                mean = mean + delta * (chunk_count / total)
+                m2 = m2 + chunk_m2 + delta**2 * (count * chunk_count / total)
+            count += chunk_count
+        if not step():
+            return None
+    if method == 'mean':
+        return mean
+    if method == 'std':
+        return np.sqrt(m2 / count)
+    return result
+
+
+def project_stack(stack: np.ndarray, method: str = 'max', chunk_frames: int = 64, band_rows: int = 256,
+                  memory_limit: int = 1 << 30, n_threads: int = None, progress=None, is_cancelled=None) -> np.ndarray:
+    """ Project a stack over its frames, streaming chunks so that a memory-mapped stack larger than memory
+        can be projected. Row-bands are projected in parallel on a thread pool.
+    @param stack: (frames, height, width) stack
+    @param method: 'max', 'min', 'mean', 'std' or 'median'
+    @param chunk_frames: number of frames read at once
+    @param band_rows: rows per band (for median, reduced so that a band of all frames fits in memory_limit).
+    @param memory_limit: memory for a median band (bytes)
+    @param n_threads: thread pool size, None for the number of CPUs.
+    @param progress: called with the fraction done (0 - 1), or None.
+    @param is_cancelled: called to check for cancellation, or None.
+    @return: (height, width) projection, or None if cancelled.
+    """
+    if method not in ('max', 'min', 'mean', 'std', 'median'):
+        raise ValueError('Unknown projection: ' + method)
+    if method == 'median':
+        row_bytes = stack.shape[0] * int(np.prod(stack.shape[2:])) * stack.dtype.itemsize
+        band_rows = max(1, min(band_rows, memory_limit // max(row_bytes, 1)))
+        n_threads = 1
+    bands = [(top, min(top + band_rows, stack.shape[1])) for top in range(0, stack.shape[1], band_rows)]
+    n_steps = len(bands) * (-(-stack.shape[0] // chunk_frames))
+    done = [0]
+    lock = threading.Lock()
+
+    def step() -> bool:
+        with lock:
+            done[0] += 1
+            if progress is not None:
+                progress(done[0] / n_steps)
+        return is_cancelled is None or not is_cancelled()
+
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as pool:
+        results = list(pool.map(lambda band: _project_band(stack, band[0], band[1], method, chunk_frames, step), bands))
+    if any(x is None for x in results):
+        return None
+    return np.concatenate(results, axis=0)
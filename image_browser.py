@@ -0,0 +1,235 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Browsing of image directories: background decoding of thumbnails and images, and a thumbnail strip.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtWidgets import (
+    QWidget,
+    QListView,
+    QAbstractItemView
+)
+from PyQt5.QtCore import (
+    Qt,
+    QObject,
+    QSize,
+    QModelIndex,
+    QAbstractListModel,
+    pyqtSignal
+)
+from PyQt5.QtGui import (
+    QImage,
+    QImageReader,
+    QPixmap,
+    QResizeEvent
+)
+
+from image_display import (
+    TileCache,
+    image_to_rgb32,
+    rgb32_to_image
+)
+from disk_cache import (
+    file_key,
+    load_array,
+    save_array
+)
+
+
+def list_images(directory: str) -> list:
+    """ Image files of a directory (of the formats that Qt can read), sorted by name.
+    """
+    suffixes = tuple('.' + bytes(x).decode().lower() for x in QImageReader.supportedImageFormats())
+    names = sorted(x for x in os.listdir(directory) if x.lower().endswith(suffixes))
+    return [os.path.join(directory, x) for x in names]
+
+
+def read_scaled(path: str, max_size: int) -> QImage:
+    """ Image of a file, decoded at a reduced size if it is larger than max_size (width or height).
+    """
+    reader = QImageReader(path)
+    size = reader.size()
+    if size.isValid() and max(size.width(), size.height()) > max_size:
+        reader.setScaledSize(size.scaled(max_size, max_size, Qt.KeepAspectRatio))
+    return reader.read()
+
+
+class ImageDecoder(QObject):
+    """ Decodes images of files on pools of worker threads: thumbnails (cached on disk), and full images
+        that are about to be shown (prefetched, and cached in memory).
+        Requests that are no longer wanted by the time a worker gets to them are skipped: thumbnails
+        scrolled out of view and images no longer near the shown one.
+    """
+
+    # emitted with a file and its thumbnail/image, on the GUI thread
+    thumbnail_ready = pyqtSignal(str, QImage)
+    image_ready = pyqtSignal(str, QImage)
+
+    def __init__(self, thumbnail_size: int = 96, max_images: int = 8, n_threads: int = None,
+                 parent: QObject = None):
+        """
+        @param thumbnail_size: largest thumbnail width or height (pixels)
+        @param max_images: maximum number of full images kept in memory
+        @param n_threads: thumbnail pool size, None for the number of CPUs.
+        """
+        super().__init__(parent)
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_pool = ThreadPoolExecutor(n_threads or os.cpu_count())
+        self.image_pool = ThreadPoolExecutor(2)
+        # decoded full images, {path: QImage}
+        self.images = TileCache(max_images)
+        self.image_ready.connect(self.images.put)
+        # files whose thumbnails/images are wanted, and requests not yet done
+        self.wanted_thumbnails = set()
+        self.wanted_images = set()
+        self.pending = set()
+
+    def request_thumbnail(self, path: str):
+        """ Decode the thumbnail of a file (emitted by thumbnail_ready), unless it is no longer wanted by then.
+        """
+        self.wanted_thumbnails.add(path)
+        if ('thumbnail', path) not in self.pending:
+            self.pending.add(('thumbnail', path))
+            self.thumbnail_pool.submit(self.decode_thumbnail, path)
+
+    def set_wanted_thumbnails(self, paths: list):
+        """ Set the files whose thumbnails are wanted (e.g. those in view).
+        """
+        self.wanted_thumbnails = set(paths)
+
+    def decode_thumbnail(self, path: str):
+        """ Worker: thumbnail of a file, from the disk cache or by a reduced-size decode.
+        """
+        try:
+            if path not in self.wanted_thumbnails:
+                return
+            try:
+                key = file_key(path, 'thumbnail', self.thumbnail_size)
+            except OSError:
+                return
+            pixels = load_array('thumbnails', key)
+            if pixels is not None:
+                image = rgb32_to_image(pixels)
+            else:
+                image = read_scaled(path, self.thumbnail_size)
+                if image.isNull():
+                    return
+                save_array('thumbnails', key, image_to_rgb32(image))
+            self.thumbnail_ready.emit(path, image)
+        finally:
+            self.pending.discard(('thumbnail', path))
+
+    def image(self, path: str) -> QImage:
+        """ Decoded full image of a file, or None if it hasn't been decoded.
+        """
+        return self.images.get(path)
+
+    def prefetch(self, paths: list):
+        """ Decode full images (emitted by image_ready) in order, e.g. the shown image then its neighbours.
+            Images requested before that are not among these are no longer wanted.
+        """
+        self.wanted_images = set(paths)
+        for path in paths:
+            if self.images.get(path) is None and ('image', path) not in self.pending:
+                self.pending.add(('image', path))
+                self.image_pool.submit(self.decode_image, path)
+
+    def decode_image(self, path: str):
+        """ Worker: full image of a file.
+        """
+        try:
+            if path in self.wanted_images:
+                image = QImageReader(path).read()
+                if not image.isNull():
+                    self.image_ready.emit(path, image)
+        finally:
+            self.pending.discard(('image', path))
+
+    def shutdown(self):
+        """ Drop requests not yet started, and stop the workers.
+        """
+        self.wanted_thumbnails = set()
+        self.wanted_images = set()
+        self.thumbnail_pool.shutdown(wait=False)
+        self.image_pool.shutdown(wait=False)
+
+
+class ThumbnailModel(QAbstractListModel):
+    """ List of image files with their thumbnails. Thumbnails are requested from the decoder when a view
+        asks for them (i.e. when they are shown), and kept in memory up to a limit.
+    """
+
+    def __init__(self, paths: list, decoder: ImageDecoder, max_thumbnails: int = 2048, parent: QObject = None):
+        super().__init__(parent)
+        self.paths = paths
+        self.rows = {path: row for row, path in enumerate(paths)}
+        self.decoder = decoder
+        self.thumbnails = TileCache(max_thumbnails)
+        decoder.thumbnail_ready.connect(self.set_thumbnail)
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        path = self.paths[index.row()]
+        if role == Qt.DecorationRole:
+            thumbnail = self.thumbnails.get(path)
+            if thumbnail is None:
+                self.decoder.request_thumbnail(path)
+            return thumbnail
+        if role == Qt.ToolTipRole:
+            return path
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        return None
+
+    def set_thumbnail(self, path: str, image: QImage):
+        """ Slot for a decoded thumbnail.
+        """
+        row = self.rows.get(path)
+        if row is not None:
+            self.thumbnails.put(path, QPixmap.fromImage(image))
+            self.dataChanged.emit(self.index(row), self.index(row), [Qt.DecorationRole])
+
+
+class ThumbnailStrip(QListView):
+    """ Horizontal strip of thumbnails. Only the items in view are drawn (and their thumbnails decoded),
+        so the strip can list any number of files.
+    """
+
+    def __init__(self, model: ThumbnailModel, parent: QWidget = None):
+        super().__init__(parent)
+        size = model.decoder.thumbnail_size
+        self.setModel(model)
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(False)
+        self.setUniformItemSizes(True)
+        self.setViewMode(QListView.IconMode)
+        self.setIconSize(QSize(size, size))
+        self.setGridSize(QSize(size + 8, size + 24))
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setHorizontalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        self.setFixedHeight(size + 24 + self.horizontalScrollBar().sizeHint().height() + 2 * self.frameWidth())
+        self.horizontalScrollBar().valueChanged.connect(self.update_wanted)
+
+    def resizeEvent(self, event: QResizeEvent):
+        """ Overrides QListView::resizeEvent
+        """
+        super().resizeEvent(event)
+        self.update_wanted()
+
+    def update_wanted(self):
+        """ Tell the decoder which thumbnails are in view, so it skips those scrolled past.
+        """
+        model = self.model()
+        step = max(self.gridSize().width(), 1)
+        start = self.horizontalScrollBar().value() // step
+        count = self.viewport().width() // step + 2
+        model.decoder.set_wanted_thumbnails(model.paths[start:start + count])
@@ -0,0 +1,359 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Tiled display of image data: per-channel lookup tables, compositing of channels and label overlays.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+from abc import (
+    ABC,
+    abstractmethod
+)
+from collections import OrderedDict
+
+import numpy as np
+
+from PyQt5.QtGui import (
+    QImage,
+    QPixmap
+)
+
+from image_filters import FilterPipeline
+
+# ------------------------------------------------
+# Tiles
+# ------------------------------------------------
+
+
+class TileCache:
+    """ Least-recently-used cache of tiles (or anything else), with a limit on the number of items.
+    """
+
+    def __init__(self, max_items: int = 1024):
+        self.max_items = max_items
+        self.items = OrderedDict()
+
+    def get(self, key):
+        """ Cached item, or None.
+        """
+        item = self.items.get(key)
+        if item is not None:
+            self.items.move_to_end(key)
+        return item
+
+    def put(self, key, item):
+        """ Cache an item, evicting the least recently used items beyond the limit.
+        """
+        self.items[key] = item
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def drop(self, predicate):
+        """ Drop the items whose keys satisfy predicate(key).
+        """
+        for key in [x for x in self.items if predicate(x)]:
+            del self.items[key]
+
+    def clear(self):
+        self.items.clear()
+
+
+def rgb_to_image(rgb: np.ndarray) -> QImage:
+    """ Image of a (height, width, 3) uint8 array.
+    """
+    rgb = np.ascontiguousarray(rgb)
+    return QImage(rgb.data, rgb.shape[1], rgb.shape[0], rgb.strides[0], QImage.Format_RGB888).copy()
+
+
+def image_to_array(image: QImage) -> np.ndarray:
+    """ Pixels of an image: a (height, width) array if it is grayscale (uint16 for a 16-bit image, otherwise uint8),
+        otherwise (height, width, 3) uint8 RGB.
+    """
+    if image.format() == QImage.Format_Grayscale16:
+        bits = image.constBits()
+        bits.setsize(image.bytesPerLine() * image.height())
+        rows = np.frombuffer(bits, dtype=np.uint16).reshape(image.height(), image.bytesPerLine() // 2)
+        return rows[:, :image.width()].copy()
+    if image.isGrayscale():
+        image = image.convertToFormat(QImage.Format_Grayscale8)
+        bits = image.constBits()
+        bits.setsize(image.bytesPerLine() * image.height())
+        rows = np.frombuffer(bits, dtype=np.uint8).reshape(image.height(), image.bytesPerLine())
+        return rows[:, :image.width()].copy()
+    # 32-bit RGB is stored as BGRA bytes (on little-endian machines)
+    return image_to_rgb32(image)[..., 2::-1].copy()
+
+
+def image_to_rgb32(image: QImage) -> np.ndarray:
+    """ (height, width, 4) uint8 array of an image's pixels in 32-bit RGB format (a copy).
+    """
+    image = image.convertToFormat(QImage.Format_RGB32)
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * image.height())
+    rows = np.frombuffer(bits, dtype=np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :4 * image.width()].reshape(image.height(), image.width(), 4).copy()
+
+
+def rgb32_to_image(pixels: np.ndarray) -> QImage:
+    """ Image of a (height, width, 4) uint8 array in 32-bit RGB format.
+    """
+    pixels = np.ascontiguousarray(pixels)
+    return QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.strides[0], QImage.Format_RGB32).copy()
+
+
+class TileGrid:
+    """ Division of an image into square tiles.
+    """
+
+    def __init__(self, shape: tuple, tile_size: int = 256):
+        """
+        @param shape: (height, width) of the layer
+        @param tile_size: tile width and height (pixels)
+        """
+        self.shape = tuple(shape[:2])
+        self.tile_size = tile_size
+
+    def tile_bounds(self, row: int, column: int) -> tuple:
+        """ Pixel bounds of a tile: top, bottom, left, right.
+        """
+        top = row * self.tile_size
+        left = column * self.tile_size
+        return top, min(top + self.tile_size, self.shape[0]), left, min(left + self.tile_size, self.shape[1])
+
+    def tile_range(self, top: float, bottom: float, left: float, right: float) -> tuple:
+        """ Tiles overlapping a region of the image.
+        @return: ranges of tile rows and columns
+        """
+        rows = range(max(0, int(top // self.tile_size)),
+                     min(int(np.ceil(bottom / self.tile_size)), -(-self.shape[0] // self.tile_size)))
+        columns = range(max(0, int(left // self.tile_size)),
+                        min(int(np.ceil(right / self.tile_size)), -(-self.shape[1] // self.tile_size)))
+        return rows, columns
+
+
+class TiledLayer(TileGrid, ABC):
+    """ Base class for image layers drawn as square tiles.
+    """
+
+    @abstractmethod
+    def tile(self, row: int, column: int) -> QPixmap:
+        """ Pixmap of a tile. Tiles are cached as pixmaps, so they are not converted for display on each paint.
+        """
+        pass
+
+
+# ------------------------------------------------
+# Channels
+# ------------------------------------------------
+
+
+class Channel:
+    """ One channel of an image, with its display settings: color, window (low, high), visibility
+        and filters.
+    """
+
+    def __init__(self, data: np.ndarray, color: tuple = (255, 255, 255), low: float = None, high: float = None,
+                 visible: bool = True, filters: FilterPipeline = None):
+        """
+        @param data: (height, width) channel data
+        @param color: RGB color that the channel's high value is shown as.
+        @param low: value shown as black, None for the (sampled) data minimum.
+        @param high: value shown at full color, None for the (sampled) data maximum.
+        @param visible: whether the channel is shown.
+        @param filters: filters applied to the data for display, or None.
+        """
+        self.data = data
+        self.filters = filters
+        self.color = tuple(color)
+        sample = data[::max(1, data.shape[0] // 512), ::max(1, data.shape[1] // 512)]
+        self.low = float(np.min(sample)) if low is None else low
+        self.high = float(np.max(sample)) if high is None else high
+        self.visible = visible
+        self._lut = None
+
+    def set_window(self, low: float, high: float):
+        self.low = low
+        self.high = high
+        self._lut = None
+
+    def set_color(self, color: tuple):
+        self.color = tuple(color)
+        self._lut = None
+
+    def values(self, top: int, bottom: int, left: int, right: int) -> np.ndarray:
+        """ Values of a region of the channel, filtered if the channel has filters.
+        """
+        if self.filters is None or not self.filters.filters:
+            return np.asarray(self.data[top:bottom, left:right])
+        return self.filters.apply(self.data, top, bottom, left, right)
+
+    def scale(self, values: np.ndarray) -> np.ndarray:
+        """ Values scaled by the window to [0, 1].
+        """
+        return np.clip((values.astype(np.float32) - self.low) / max(self.high - self.low, 1e-12), 0, 1)
+
+    def lut(self) -> np.ndarray:
+        """ Lookup table from (uint8 or uint16) value to RGB, as a (256 or 65536, 3) uint8 array.
+        """
+        if self._lut is None:
+            levels = self.scale(np.arange(np.iinfo(self.data.dtype).max + 1))
+            self._lut = np.round(levels[:, None] * np.array(self.color, dtype=np.float32)).astype(np.uint8)
+        return self._lut
+
+    def to_rgb(self, values: np.ndarray) -> np.ndarray:
+        """ Map data values to RGB.
+            8- and 16-bit data are mapped by table lookup; other data are scaled directly.
+        @param values: (height, width) values of this channel
+        @return: (height, width, 3) uint8 array
+        """
+        if values.dtype in (np.uint8, np.uint16):
+            return self.lut()[values]
+        levels = self.scale(values)
+        return np.round(levels[..., None] * np.array(self.color, dtype=np.float32)).astype(np.uint8)
+
+
+class ChannelCompositor(TiledLayer):
+    """ Additive composite of channels, computed and cached per tile.
+        The RGB layer of each channel is cached per tile as well as the composite, so showing or hiding
+        a channel only re-adds cached layers for tiles that are drawn, without re-reading the data.
+    """
+
+    def __init__(self, channels: list, tile_size: int = 256, max_tiles: int = 1024):
+        """
+        @param channels: channels, all of the same shape
+        @param tile_size: tile width and height (pixels)
+        @param max_tiles: maximum number of cached tiles (composites and channel layers each)
+        """
+        super().__init__(channels[0].data.shape, tile_size)
+        self.channels = channels
+        # {(row, column): QPixmap}
+        self.composites = TileCache(max_tiles)
+        # {(channel, row, column): RGB array}
+        self.layers = TileCache(max_tiles)
+
+    def layer(self, index: int, row: int, column: int) -> np.ndarray:
+        """ RGB layer of one channel for a tile.
+        """
+        layer = self.layers.get((index, row, column))
+        if layer is None:
+            top, bottom, left, right = self.tile_bounds(row, column)
+            channel = self.channels[index]
+            layer = channel.to_rgb(channel.values(top, bottom, left, right))
+            self.layers.put((index, row, column), layer)
+        return layer
+
+    def tile(self, row: int, column: int) -> QPixmap:
+        """ Composite of a tile: saturating sum of the visible channel layers.
+        """
+        image = self.composites.get((row, column))
+        if image is None:
+            top, bottom, left, right = self.tile_bounds(row, column)
+            total = np.zeros((bottom - top, right - left, 3), dtype=np.uint16)
+            for i, channel in enumerate(self.channels):
+                if channel.visible:
+                    total += self.layer(i, row, column)
+            image = QPixmap.fromImage(rgb_to_image(np.minimum(total, 255).astype(np.uint8)))
+            self.composites.put((row, column), image)
+        return image
+
+    def set_visible(self, index: int, visible: bool):
+        """ Show or hide a channel. Composites are redone from the cached layers.
+        """
+        self.channels[index].visible = visible
+        self.composites.clear()
+
+    def set_window(self, index: int, low: float, high: float):
+        """ Set the window of a channel. Its layers are redone from the data.
+        """
+        self.channels[index].set_window(low, high)
+        self.channel_changed(index)
+
+    def set_color(self, index: int, color: tuple):
+        """ Set the color of a channel. Its layers are redone from the data.
+        """
+        self.channels[index].set_color(color)
+        self.channel_changed(index)
+
+    def set_filters(self, index: int, filters: FilterPipeline):
+        """ Set the filters of a channel. Its layers are redone from the data when next drawn.
+        """
+        self.channels[index].filters = filters
+        self.channel_changed(index)
+
+    def channel_changed(self, index: int):
+        """ Drop the cached layers of a channel, e.g. after a change to one of its filters' parameters.
+        """
+        self.layers.drop(lambda key: key[0] == index)
+        self.composites.clear()
+
+
+# ------------------------------------------------
+# Label overlay
+# ------------------------------------------------
+
+
+class LabelOverlay(TiledLayer):
+    """ Overlay of an integer label image (e.g. a segmentation), colored through a label -> RGBA lookup table.
+        Label 0 is transparent. Tiles are cached; recoloring a label changes its table entry and drops only the
+        cached tiles within the label's bounding box.
+    """
+
+    def __init__(self, labels: np.ndarray, statistics=None, opacity: float = 0.5, tile_size: int = 256,
+                 max_tiles: int = 1024, seed: int = 0):
+        """
+        @param labels: (height, width) uint16 or uint32 label image
+        @param statistics: image_analysis.LabelStatistics of the labels (for bounding boxes), or None.
+        @param opacity: opacity of the overlay, applied when drawing.
+        @param tile_size: tile width and height (pixels)
+        @param max_tiles: maximum number of cached tiles
+        @param seed: seed of the random label colors
+        """
+        super().__init__(labels.shape, tile_size)
+        self.labels = labels
+        self.statistics = statistics
+        self.opacity = opacity
+        n_labels = statistics.n_labels if statistics is not None else int(labels.max()) + 1
+        # random opaque colors; background transparent
+        self.lut = np.random.default_rng(seed).integers(40, 256, size=(n_labels, 4)).astype(np.uint8)
+        self.lut[:, 3] = 255
+        self.lut[0] = 0
+        self.highlighted = None
+        self.highlighted_color = None
+        self.tiles = TileCache(max_tiles)
+
+    def tile(self, row: int, column: int) -> QPixmap:
+        image = self.tiles.get((row, column))
+        if image is None:
+            top, bottom, left, right = self.tile_bounds(row, column)
+            rgba = np.ascontiguousarray(self.lut[self.labels[top:bottom, left:right]])
+            image = QPixmap.fromImage(
+                QImage(rgba.data, rgba.shape[1], rgba.shape[0], rgba.strides[0], QImage.Format_RGBA8888))
+            self.tiles.put((row, column), image)
+        return image
+
+    def set_color(self, label: int, rgba: tuple):
+        """ Recolor a label.
+        """
+        self.lut[label] = rgba
+        if self.statistics is None:
+            self.tiles.clear()
+            return
+        tile_rows, tile_columns = self.tile_range(self.statistics.top[label], self.statistics.bottom[label],
+                                                  self.statistics.left[label], self.statistics.right[label])
+        self.tiles.drop(lambda key: key[0] in tile_rows and key[1] in tile_columns)
+
+    def highlight(self, label: int, rgba: tuple = (255, 255, 255, 255)):
+        """ Highlight a label (and restore the color of the previously highlighted label).
+        @param label: label to highlight, or None/0 to only clear the previous highlight.
+        @param rgba: highlight color
+        """
+        if self.highlighted is not None:
+            self.set_color(self.highlighted, self.highlighted_color)
+            self.highlighted = None
+        if label:
+            self.highlighted = label
+            self.highlighted_color = self.lut[label].copy()
+            self.set_color(label, rgba)
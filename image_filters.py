@@ -0,0 +1,209 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Image filters that can be evaluated on tiles: gaussian blur, median, background subtraction and dF/F.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+from abc import (
+    ABC,
+    abstractmethod
+)
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ------------------------------------------------
+# Filters
+#
+# Each filter needs a halo of surrounding pixels to give exact values over a tile. Filters work on
+# float32 arrays and are applied by a FilterPipeline, which reads each tile with the total halo of its filters.
+# Beyond the image, the edge values are repeated (at each step of a filter that works in steps, see repeat_edges).
+# ------------------------------------------------
+
+
+class ImageFilter(ABC):
+    """ Base class for filters.
+    """
+
+    @abstractmethod
+    def halo(self) -> int:
+        """ Number of pixels needed around a region to filter it exactly.
+        """
+        pass
+
+    @abstractmethod
+    def apply(self, values: np.ndarray, top: int, left: int, shape: tuple = None) -> np.ndarray:
+        """ Filter a region of the image.
+        @param values: (height, width) float32 values of the region
+        @param top: image row of the region's first row
+        @param left: image column of the region's first column
+        @param shape: (height, width) of the image, None if the region is the whole image.
+        @return: filtered values, same shape.
+        """
+        pass
+
+
+def read_region(data: np.ndarray, top: int, left: int, height: int, width: int) -> np.ndarray:
+    """ float32 values of a region of an image; beyond the image the edge values are repeated.
+    """
+    read_top, read_bottom = min(max(top, 0), data.shape[0] - 1), min(max(top + height, 1), data.shape[0])
+    read_left, read_right = min(max(left, 0), data.shape[1] - 1), min(max(left + width, 1), data.shape[1])
+    values = np.asarray(data[read_top:read_bottom, read_left:read_right], dtype=np.float32)
+    return np.pad(values, [(read_top - top, top + height - read_bottom),
+                           (read_left - left, left + width - read_right)], mode='edge')
+
+
+def repeat_edges(values: np.ndarray, top: int, left: int, shape: tuple = None) -> np.ndarray:
+    """ Values of a region with the parts beyond the image replaced by the image's edge values within the region.
+    @param values: (height, width) values of the region
+    @param top: image row of the region's first row
+    @param left: image column of the region's first column
+    @param shape: (height, width) of the image, None if the region is the whole image.
+    """
+    if shape is None or (top >= 0 and left >= 0 and top + values.shape[0] <= shape[0]
+                         and left + values.shape[1] <= shape[1]):
+        return values
+    rows = np.clip(np.arange(top, top + values.shape[0]), 0, shape[0] - 1) - top
+    columns = np.clip(np.arange(left, left + values.shape[1]), 0, shape[1] - 1) - left
+    return values[np.ix_(rows, columns)]
+
+
+def _window_reduce(values: np.ndarray, size: int, axis: int, reducer) -> np.ndarray:
+    """ Reduce a centred window of each pixel along an axis (edges padded with edge values).
+    """
+    half = size // 2
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (half, half)
+    windows = sliding_window_view(np.pad(values, pad, mode='edge'), size, axis=axis)
+    return reducer(windows)
+
+
+class GaussianFilter(ImageFilter):
+    """ Gaussian blur, as two 1D convolutions.
+    """
+
+    def __init__(self, sigma: float = 1.0):
+        self.sigma = sigma
+
+    def halo(self) -> int:
+        return int(np.ceil(3 * self.sigma))
+
+    def apply(self, values: np.ndarray, top: int, left: int, shape: tuple = None) -> np.ndarray:
+        half = self.halo()
+        if half == 0:
+            return values
+        kernel = np.exp(-0.5 * (np.arange(-half, half + 1) / self.sigma)**2).astype(np.float32)
+        kernel /= kernel.sum()
+        values = _window_reduce(values, len(kernel), 1, lambda w: w @ kernel)
+        return _window_reduce(values, len(kernel), 0, lambda w: w @ kernel)
+
+
+class MedianFilter(ImageFilter):
+    """ Median over a square window.
+    """
+
+    def __init__(self, size: int = 3):
+        self.size = size
+
+    def halo(self) -> int:
+        return self.size // 2
+
+    def apply(self, values: np.ndarray, top: int, left: int, shape: tuple = None) -> np.ndarray:
+        half = self.halo()
+        windows = sliding_window_view(np.pad(values, half, mode='edge'), (self.size, self.size))
+        return np.median(windows, axis=(-2, -1)).astype(np.float32)
+
+
+class RollingBallBackground(ImageFilter):
+    """ Background subtraction by a grey-scale opening (minimum then maximum filter).
+        The ball is approximated by a flat square of side 2 * radius + 1, so each filter is separable.
+    """
+
+    def __init__(self, radius: int = 25):
+        self.radius = radius
+
+    def halo(self) -> int:
+        return 2 * self.radius
+
+    def apply(self, values: np.ndarray, top: int, left: int, shape: tuple = None) -> np.ndarray:
+        size = 2 * self.radius + 1
+        background = _window_reduce(values, size, 1, lambda w: w.min(axis=-1))
+        background = _window_reduce(background, size, 0, lambda w: w.min(axis=-1))
+        background = repeat_edges(background, top, left, shape)
+        background = _window_reduce(background, size, 1, lambda w: w.max(axis=-1))
+        background = _window_reduce(background, size, 0, lambda w: w.max(axis=-1))
+        return values - background
+
+
+class ConstantBackground(ImageFilter):
+    """ Subtraction of a constant background.
+    """
+
+    def __init__(self, value: float = 0.0):
+        self.value = value
+
+    def halo(self) -> int:
+        return 0
+
+    def apply(self, values: np.ndarray, top: int, left: int, shape: tuple = None) -> np.ndarray:
+        return values - np.float32(self.value)
+
+
+class DeltaFOverF(ImageFilter):
+    """ (F - F0) / F0, with F0 a constant or a baseline image (e.g. a mean projection of a stack).
+    """
+
+    def __init__(self, baseline=1.0):
+        """
+        @param baseline: F0, a number or a (height, width) array of the whole image.
+        """
+        self.baseline = baseline
+
+    def halo(self) -> int:
+        return 0
+
+    def apply(self, values: np.ndarray, top: int, left: int, shape: tuple = None) -> np.ndarray:
+        baseline = self.baseline
+        if isinstance(baseline, np.ndarray):
+            baseline = read_region(baseline, top, left, values.shape[0], values.shape[1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nan_to_num((values - baseline) / baseline).astype(np.float32)
+
+
+# ------------------------------------------------
+# Pipeline
+# ------------------------------------------------
+
+
+class FilterPipeline:
+    """ Chain of filters, applied to regions of an image with a halo so that region edges are exact:
+        filtering a region gives the values of filtering the whole image, including at the image edges.
+    """
+
+    def __init__(self, filters: list = None):
+        self.filters = [] if filters is None else filters
+
+    def halo(self) -> int:
+        return sum(x.halo() for x in self.filters)
+
+    def apply(self, data: np.ndarray, top: int, bottom: int, left: int, right: int) -> np.ndarray:
+        """ Filtered values of a region of an image.
+            The region is read with the pipeline's halo; beyond the image the edge values are repeated.
+        @param data: (height, width) image
+        @param top: first row of the region
+        @param bottom: last row (exclusive)
+        @param left: first column
+        @param right: last column (exclusive)
+        @return: (bottom - top, right - left) float32 values
+        """
+        halo = self.halo()
+        values = read_region(data, top - halo, left - halo, bottom - top + 2 * halo, right - left + 2 * halo)
+        # where the region extends beyond the image, the edge values of each filter's output are repeated
+        # before the next filter, as when filtering the whole image one filter at a time
+        for image_filter in self.filters:
+            values = image_filter.apply(values, top - halo, left - halo, data.shape[:2])
+            values = repeat_edges(values, top - halo, left - halo, data.shape[:2])
+        return values[halo:halo + bottom - top, halo:halo + right - left]
@@ -0,0 +1,202 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Background jobs for the image viewer, run on threads with progress and cancellation.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+from abc import abstractmethod
+
+import numpy as np
+
+from PyQt5.QtCore import (
+    QObject,
+    QThread,
+    pyqtSignal
+)
+from PyQt5.QtGui import QImageReader
+
+from image_analysis import (
+    project_stack,
+    rgb_to_gray
+)
+from image_display import image_to_array
+from image_registration import (
+    estimate_drift,
+    track_rois
+)
+from tiff_stack import TiffStack
+
+
+class Job(QThread):
+    """ Base class for background jobs: a thread with progress (percent) and cancellation.
+        Subclasses implement compute(), emitting progress through set_progress() and checking
+        self.is_cancelled; the result is emitted by the done signal unless the job was cancelled,
+        and the message of an error by the failed signal (likewise).
+    """
+
+    progress = pyqtSignal(int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, parent: QObject = None):
+        super().__init__(parent)
+        self.is_cancelled = False
+
+    def cancel(self):
+        """ Ask the job to stop. Slot for e.g. QProgressDialog::canceled.
+        """
+        self.is_cancelled = True
+
+    def set_progress(self, fraction: float):
+        self.progress.emit(int(100 * fraction))
+
+    def run(self):
+        """ Overrides QThread::run().
+        """
+        try:
+            result = self.compute()
+        except Exception as error:
+            if not self.is_cancelled:
+                self.failed.emit('{}: {}'.format(type(error).__name__, error))
+            return
+        if result is not None and not self.is_cancelled:
+            self.done.emit(result)
+
+    @abstractmethod
+    def compute(self):
+        """ Do the work.
+        @return: result, or None if cancelled.
+        """
+        pass
+
+
+class ProjectionJob(Job):
+    """ Projection of a stack over its frames.
+    """
+
+    def __init__(self, stack: np.ndarray, method: str = 'max', parent: QObject = None):
+        """
+        @param stack: (frames, height, width) stack
+        @param method: 'max', 'min', 'mean', 'std' or 'median'
+        """
+        super().__init__(parent)
+        self.stack = stack
+        self.method = method
+
+    def compute(self):
+        return project_stack(self.stack, self.method, progress=self.set_progress,
+                             is_cancelled=lambda: self.is_cancelled)
+
+
+class DriftJob(Job):
+    """ Estimation of the drift of each frame of a stack relative to a reference frame.
+    """
+
+    def __init__(self, stack: np.ndarray, reference: int = 0, parent: QObject = None):
+        """
+        @param stack: (frames, height, width) stack
+        @param reference: index of the reference frame
+        """
+        super().__init__(parent)
+        self.stack = stack
+        self.reference = reference
+
+    def compute(self):
+        return estimate_drift(self.stack, self.reference, progress=self.set_progress,
+                              is_cancelled=lambda: self.is_cancelled)
+
+
+class TrackingJob(Job):
+    """ Tracking of regions through a stack by template matching.
+    """
+
+    def __init__(self, stack: np.ndarray, boxes: np.ndarray, reference: int = 0, search_radius: int = 10,
+                 parent: QObject = None):
+        """
+        @param stack: (frames, height, width) stack
+        @param boxes: (n, 4) region bounding boxes in the reference frame: top, left, height, width.
+        @param reference: index of the reference frame
+        @param search_radius: largest movement between consecutive frames (pixels)
+        """
+        super().__init__(parent)
+        self.stack = stack
+        self.boxes = boxes
+        self.reference = reference
+        self.search_radius = search_radius
+
+    def compute(self):
+        return track_rois(self.stack, self.boxes, self.reference, self.search_radius, progress=self.set_progress,
+                          is_cancelled=lambda: self.is_cancelled)
+
+
+class ImageDecodeJob(Job):
+    """ Decoding of an image file at full resolution.
+        A decode can't be interrupted; if the job is cancelled, the image is discarded.
+    """
+
+    def __init__(self, path: str, parent: QObject = None):
+        """
+        @param path: image file
+        """
+        super().__init__(parent)
+        self.path = path
+
+    def compute(self):
+        image = QImageReader(self.path).read()
+        self.set_progress(1)
+        return None if image.isNull() else image
+
+
+class FileStackJob(Job):
+    """ Decoding of image files of the same size into a stack, one frame per file, of the pixel type of the
+        first file (e.g. 16-bit). All files must have the same size and pixel type. RGB files are stacked as
+        their gray values (see rgb_to_gray), as stacks hold one value per pixel.
+    """
+
+    def __init__(self, paths: list, parent: QObject = None):
+        """
+        @param paths: image files
+        """
+        super().__init__(parent)
+        self.paths = paths
+
+    def compute(self):
+        stack = None
+        for i, path in enumerate(self.paths):
+            if self.is_cancelled:
+                return None
+            frame = image_to_array(QImageReader(path).read())
+            if frame.ndim == 3:
+                frame = rgb_to_gray(frame)
+            if stack is None:
+                stack = np.zeros((len(self.paths),) + frame.shape, dtype=frame.dtype)
+            if frame.shape != stack.shape[1:] or frame.dtype != stack.dtype:
+                raise ValueError('{} differs in size or pixel type from {}.'.format(path, self.paths[0]))
+            stack[i] = frame
+            self.set_progress((i + 1) / len(self.paths))
+        return stack
+
+
+class TiffStackJob(Job):
+    """ Opening of a multi-page TIFF file as a stack (which walks its chain of pages, unless it has been
+        indexed before).
+    """
+
+    def __init__(self, path: str, parent: QObject = None):
+        """
+        @param path: TIFF file
+        """
+        super().__init__(parent)
+        self.path = path
+
+    def compute(self):
+        """
+        @return: the stack, or False if the file isn't a TIFF file that can be read as a stack.
+        """
+        try:
+            return TiffStack(self.path)
+        except (OSError, ValueError):
+            return False
@@ -0,0 +1,440 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Panels that show measurements from an image scene (line profiles and histograms of the view), and an
+# overview of the scene for navigation.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import numpy as np
+
+from PyQt5.QtWidgets import (
+    QWidget,
+    QGraphicsScene
+)
+from PyQt5.QtCore import (
+    Qt,
+    QThread,
+    QTimer,
+    QPointF,
+    QRectF,
+    pyqtSignal
+)
+from PyQt5.QtGui import (
+    QMouseEvent,
+    QPixmap,
+    QPainter,
+    QPen,
+    QPolygonF,
+    QPaintEvent
+)
+
+from SelectionRoi import (
+    SelectionRoi,
+    PathRoi
+)
+from image_analysis import (
+    line_profile,
+    sample_values
+)
+from image_display import (
+    TileCache,
+    TileGrid
+)
+
+# ------------------------------------------------
+# Plot
+# ------------------------------------------------
+
+
+class ProfilePlot(QWidget):
+    """ Minimal line plot of y against x, scaled to fill the widget.
+    """
+
+    def __init__(self, parent: QWidget = None):
+        super().__init__(parent)
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.margin = 10
+        self.setMinimumSize(200, 120)
+
+    def set_data(self, x: np.ndarray, y: np.ndarray):
+        """ Set the data to plot.
+        """
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.update()
+
+    def paintEvent(self, event: QPaintEvent):
+        """ Draw the line.
+            Overrides QWidget::paintEvent
+        """
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        if len(self.x) < 2:
+            return
+        # data to widget coordinates (y up)
+        width = self.width() - 2 * self.margin
+        height = self.height() - 2 * self.margin
+        x_range = max(self.x[-1] - self.x[0], 1e-12)
+        y_min, y_max = float(np.min(self.y)), float(np.max(self.y))
+        y_range = max(y_max - y_min, 1e-12)
+        px = self.margin + (self.x - self.x[0]) / x_range * width
+        py = self.margin + height - (self.y - y_min) / y_range * height
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(QPen(Qt.black, 1.0))
+        painter.drawPolyline(QPolygonF([QPointF(a, b) for a, b in zip(px, py)]))
+        painter.drawText(self.margin, self.margin, '{:.4g}'.format(y_max))
+        painter.drawText(self.margin, self.height() - 2, '{:.4g}'.format(y_min))
+
+
+# ------------------------------------------------
+# Line profile
+# ------------------------------------------------
+
+
+class ProfileSampler(QThread):
+    """ Thread for sampling a line profile.
+    """
+
+    sampled = pyqtSignal(object, object)
+
+    def __init__(self, parent: QWidget):
+        super().__init__(parent)
+        self.array = None
+        self.x = []
+        self.y = []
+        self.step = 0.5
+        self.width = 1.0
+
+    def run(self):
+        """ Overrides QThread::run().
+            Sample the profile and emit the distances and values.
+        """
+        distance, values = line_profile(self.array, self.x, self.y, self.step, self.width)
+        self.sampled.emit(distance, values)
+
+
+class LineProfileWindow(QWidget):
+    """ Live intensity profile along a path ROI, following the scene's image (e.g. the frame shown).
+        Changes to the ROI or the image only mark the profile as stale: a frame-rate timer starts the sampling
+        thread with the latest ROI geometry and image whenever the thread is idle, so drags are coalesced.
+    """
+
+    def __init__(self, scene: QGraphicsScene, array: np.ndarray, roi: PathRoi, step: float = 0.5,
+                 width: float = 1.0, frame_interval: int = 16):
+        """
+        @param scene: scene with the ROI (which has roi_geometry_changed and image_changed signals and
+                      image_array())
+        @param array: (height, width) image to sample, until the scene's image changes
+        @param roi: path ROI
+        @param step: distance between samples along the line (pixels)
+        @param width: width of the line (pixels), averaged across.
+        @param frame_interval: update interval (ms)
+        """
+        super().__init__()
+        self.setWindowTitle('Line profile')
+        self.scene = scene
+        self.array = array
+        self.roi = roi
+        self.step = step
+        self.width = width
+        self.is_stale = True
+
+        # plot
+        self.plot = ProfilePlot(self)
+        self.resize(400, 200)
+
+        # sampling
+        self.sampler = ProfileSampler(self)
+        self.sampler.sampled.connect(self.plot.set_data)
+        scene.roi_geometry_changed.connect(self.roi_changed)
+        scene.image_changed.connect(self.image_changed)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update_profile)
+        self.timer.start(frame_interval)
+
+    def resizeEvent(self, event):
+        """ Keep the plot filling the window.
+            Overrides QWidget::resizeEvent
+        """
+        self.plot.resize(self.size())
+
+    def set_width(self, width: float):
+        """ Set the line width that is averaged across.
+        """
+        self.width = width
+        self.is_stale = True
+
+    def roi_changed(self, roi: SelectionRoi):
+        """ Slot for ROI geometry changes.
+        """
+        if roi is self.roi:
+            self.is_stale = True
+
+    def image_changed(self):
+        """ Slot for changes to the scene's image: sample the new image. Ignores a preview (which has no
+            image array) and changes of display only.
+        """
+        array = self.scene.image_array()
+        if array is not None and array is not self.array:
+            self.array = array
+            self.is_stale = True
+
+    def update_profile(self):
+        """ Slot for timer: start sampling if the profile is stale and the thread is idle.
+        """
+        if not self.is_stale or self.sampler.isRunning():
+            return
+        self.is_stale = False
+        self.sampler.array = self.array
+        self.sampler.x, self.sampler.y = self.roi.scene_points()
+        self.sampler.step = self.step
+        self.sampler.width = self.width
+        self.sampler.start()
+
+    def closeEvent(self, event):
+        """ Stop updating.
+            Overrides QWidget::closeEvent
+        """
+        self.timer.stop()
+        self.sampler.wait()
+        event.accept()
+
+
+# ------------------------------------------------
+# Histogram
+# ------------------------------------------------
+
+
+class TileHistograms:
+    """ Histograms of the tiles of an image, each computed when first needed and cached, and their running sum
+        over the tiles overlapping a region. When the region moves, only the histograms of the tiles that enter or
+        leave it are added or subtracted.
+    """
+
+    def __init__(self, array: np.ndarray, tile_size: int = 256, n_bins: int = 256, value_range: tuple = None,
+                 max_tiles: int = 4096):
+        """
+        @param array: (height, width) image
+        @param tile_size: tile width and height (pixels)
+        @param n_bins: number of histogram bins
+        @param value_range: (low, high) range of the bins, None for the (sampled) range of the image.
+                            Values beyond the range are counted in the first or last bin.
+        @param max_tiles: maximum number of cached tile histograms
+        """
+        self.array = array
+        self.tiles = TileGrid(array.shape, tile_size)
+        self.n_bins = n_bins
+        if value_range is None:
+            sample = sample_values(array)
+            value_range = (float(np.min(sample)), float(np.max(sample)))
+        self.low = value_range[0]
+        self.high = max(value_range[1], self.low + 1e-12)
+        self.histograms = TileCache(max_tiles)
+        # tiles in the running sum, and the sum
+        self.summed_tiles = set()
+        self.total = np.zeros(n_bins, dtype=np.int64)
+
+    def edges(self) -> np.ndarray:
+        """ Bin edges (n_bins + 1).
+        """
+        return np.linspace(self.low, self.high, self.n_bins + 1)
+
+    def tile_histogram(self, row: int, column: int) -> np.ndarray:
+        """ Histogram of a tile.
+        """
+        counts = self.histograms.get((row, column))
+        if counts is None:
+            top, bottom, left, right = self.tiles.tile_bounds(row, column)
+            values = np.asarray(self.array[top:bottom, left:right], dtype=np.float32)
+            bins = np.clip(((values - self.low) * (self.n_bins / (self.high - self.low))).astype(np.int64),
+                           0, self.n_bins - 1)
+            counts = np.bincount(bins.ravel(), minlength=self.n_bins)
+            self.histograms.put((row, column), counts)
+        return counts
+
+    def set_region(self, top: float, bottom: float, left: float, right: float) -> np.ndarray:
+        """ Histogram of the tiles overlapping a region.
+        """
+        tile_rows, tile_columns = self.tiles.tile_range(top, bottom, left, right)
+        tiles = {(row, column) for row in tile_rows for column in tile_columns}
+        for row, column in self.summed_tiles - tiles:
+            self.total -= self.tile_histogram(row, column)
+        for row, column in tiles - self.summed_tiles:
+            self.total += self.tile_histogram(row, column)
+        self.summed_tiles = tiles
+        return self.total
+
+
+class HistogramWindow(QWidget):
+    """ Live histogram of the part of an image in view.
+        Changes to the view only mark the histogram as stale; a frame-rate timer updates it from the cached
+        histograms of the tiles in view.
+    """
+
+    def __init__(self, array: np.ndarray, n_bins: int = 256, frame_interval: int = 16,
+                 scene: QGraphicsScene = None):
+        """
+        @param array: (height, width) image
+        @param n_bins: number of histogram bins
+        @param frame_interval: update interval (ms)
+        @param scene: scene (with an image_changed signal and image_array()) whose image to follow, or None.
+        """
+        super().__init__()
+        self.setWindowTitle('Histogram')
+        self.scene = scene
+        if scene is not None:
+            scene.image_changed.connect(self.image_changed)
+        self.n_bins = n_bins
+        self.histograms = TileHistograms(array, n_bins=n_bins)
+        self.region = QRectF(0, 0, array.shape[1], array.shape[0])
+        self.is_stale = True
+
+        # plot
+        self.plot = ProfilePlot(self)
+        self.resize(400, 200)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update_histogram)
+        self.timer.start(frame_interval)
+
+    def resizeEvent(self, event):
+        """ Keep the plot filling the window.
+            Overrides QWidget::resizeEvent
+        """
+        self.plot.resize(self.size())
+
+    def set_array(self, array: np.ndarray):
+        """ Replace the image: keeping the bins if it is of the same shape (e.g. a new frame of a stack),
+            otherwise with bins over its own range. Ignores None (e.g. a preview) and the current image.
+        """
+        if array is None or array is self.histograms.array:
+            return
+        value_range = (self.histograms.low, self.histograms.high) if array.shape == self.histograms.array.shape \
+            else None
+        self.histograms = TileHistograms(array, n_bins=self.n_bins, value_range=value_range)
+        self.is_stale = True
+
+    def image_changed(self):
+        """ Slot for changes to the scene's image.
+        """
+        self.set_array(self.scene.image_array())
+
+    def set_region(self, region: QRectF):
+        """ Slot for changes to the view: set the region (in image coordinates) that is in view.
+        """
+        self.region = region
+        self.is_stale = True
+
+    def update_histogram(self):
+        """ Slot for timer: update the histogram if it is stale.
+        """
+        if not self.is_stale:
+            return
+        self.is_stale = False
+        counts = self.histograms.set_region(self.region.top(), self.region.bottom(), self.region.left(),
+                                            self.region.right())
+        edges = self.histograms.edges()
+        self.plot.set_data((edges[:-1] + edges[1:]) / 2, counts)
+
+    def closeEvent(self, event):
+        """ Stop updating.
+            Overrides QWidget::closeEvent
+        """
+        self.timer.stop()
+        event.accept()
+
+
+# ------------------------------------------------
+# Overview
+# ------------------------------------------------
+
+
+class OverviewMap(QWidget):
+    """ Overview of a whole image scene, with a rectangle showing the region in view. Clicking or dragging on
+        the overview moves the view there.
+        The overview is rendered once from a heavily reduced image (see ImageScene.overview_image) and kept as a
+        pixmap until the image changes; changes to the view only redraw the rectangle over it.
+    """
+
+    # emitted with the scene position to center the view on
+    navigated = pyqtSignal(QPointF)
+
+    def __init__(self, scene: QGraphicsScene, max_size: int = 200, parent: QWidget = None):
+        """
+        @param scene: image scene (an image_viewer6.ImageScene)
+        @param max_size: largest width or height of the overview (pixels)
+        """
+        super().__init__(parent)
+        self.scene = scene
+        self.max_size = max_size
+        self.pixmap = None
+        self.region = QRectF()
+        self.setCursor(Qt.OpenHandCursor)
+        scene.image_changed.connect(self.image_changed)
+        self.image_changed()
+
+    def image_changed(self):
+        """ Slot for changes to the image: render the overview again when next painted.
+        """
+        self.pixmap = None
+        aspect = self.scene.image_height / max(self.scene.image_width, 1)
+        if aspect <= 1:
+            self.setFixedSize(self.max_size, max(1, int(round(self.max_size * aspect))))
+        else:
+            self.setFixedSize(max(1, int(round(self.max_size / aspect))), self.max_size)
+        self.update()
+
+    def set_region(self, region: QRectF):
+        """ Slot for changes to the view: set the region (in image coordinates) that is in view.
+        """
+        self.region = region
+        self.update()
+
+    def image_scale(self) -> float:
+        """ Overview pixels per image pixel.
+        """
+        return self.width() / max(self.scene.image_width, 1)
+
+    def paintEvent(self, event: QPaintEvent):
+        """ Draw the overview and the rectangle of the view.
+            Overrides QWidget::paintEvent
+        """
+        if self.pixmap is None:
+            self.pixmap = QPixmap.fromImage(self.scene.overview_image(self.max_size))
+        painter = QPainter(self)
+        painter.drawPixmap(self.rect(), self.pixmap)
+        scale = self.image_scale()
+        region = self.region.intersected(QRectF(0, 0, self.scene.image_width, self.scene.image_height))
+        painter.setPen(QPen(Qt.yellow, 1.0))
+        painter.drawRect(QRectF(region.x() * scale, region.y() * scale, region.width() * scale,
+                                region.height() * scale).adjusted(0, 0, -1, -1))
+        painter.setPen(QPen(Qt.darkGray, 1.0))
+        painter.drawRect(self.rect().adjusted(0, 0, -1, -1))
+
+    def mousePressEvent(self, event: QMouseEvent):
+        """ Overrides QWidget::mousePressEvent
+        """
+        if event.button() == Qt.LeftButton:
+            self.setCursor(Qt.ClosedHandCursor)
+            self.navigate(event)
+
+    def mouseMoveEvent(self, event: QMouseEvent):
+        """ Overrides QWidget::mouseMoveEvent
+        """
+        if event.buttons() & Qt.LeftButton:
+            self.navigate(event)
+
+    def mouseReleaseEvent(self, event: QMouseEvent):
+        """ Overrides QWidget::mouseReleaseEvent
+        """
+        self.setCursor(Qt.OpenHandCursor)
+
+    def navigate(self, event: QMouseEvent):
+        """ Center the view on the image position under the mouse.
+        """
+        scale = self.image_scale()
+        self.navigated.emit(QPointF(event.pos().x() / scale, event.pos().y() / scale))
@@ -0,0 +1,300 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Registration of image stacks: rigid drift estimation by FFT phase correlation, lazily
+# drift-corrected stacks and ROI tracking by template matching.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# ------------------------------------------------
+# Phase correlation
+# ------------------------------------------------
+
+
+def downsample(frames: np.ndarray, factor: int) -> np.ndarray:
+    """ Block-mean downsampling of the last two axes.
+    """
+    if factor <= 1:
+        return np.asarray(frames, dtype=np.float32)
+    height = frames.shape[-2] // factor * factor
+    width = frames.shape[-1] // factor * factor
+    blocks = np.asarray(frames[..., :height, :width], dtype=np.float32)
+    blocks = blocks.reshape(frames.shape[:-2] + (height // factor, factor, width // factor, factor))
+    return blocks.mean(axis=(-3, -1))
+
+
+def _peak(correlation: np.ndarray) -> np.ndarray:
+    """ Sub-pixel position of the maximum of each correlation surface (parabolic fit on each axis),
+        as a signed shift (wrapped into [-size/2, size/2)).
+    @param correlation: (frames, height, width) circular correlations
+    @return: (frames, 2) shifts (dy, dx)
+    """
+    n, height, width = correlation.shape
+    flat = correlation.reshape(n, -1).argmax(axis=1)
+    y, x = np.divmod(flat, width)
+    frames = np.arange(n)
+    shifts = np.zeros((n, 2))
+    for axis, (position, size) in enumerate([(y, height), (x, width)]):
+        before = [frames, y, x]
+        after = [frames, y, x]
+        before[axis + 1] = (position - 1) % size
+        after[axis + 1] = (position + 1) % size
+        c_before = correlation[tuple(before)]
+        c_centre = correlation[frames, y, x]
+        c_after = correlation[tuple(after)]
+        denominator = c_before - 2 * c_centre + c_after
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(denominator < 0, 0.5 * (c_before - c_after) / denominator, 0)
+        shifts[:, axis] = (position + offset + size / 2) % size - size / 2
+    return shifts
+
+
+def phase_correlation(reference: np.ndarray, frames: np.ndarray) -> np.ndarray:
+    """ Shifts that align frames to a reference, from the peaks of their phase correlations.
+    @param reference: (height, width) reference image
+    @param frames: (frames, height, width) images
+    @return: (frames, 2) shifts (dy, dx): frame(y, x) ~ reference(y - dy, x - dx).
+    """
+    reference_fft = np.fft.rfft2(reference - reference.mean())
+    frames = np.asarray(frames, dtype=np.float32)
+    frames_fft = np.fft.rfft2(frames - frames.mean(axis=(-2, -1), keepdims=True))
+    cross_power = frames_fft * np.conj(reference_fft)
+    cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+    return _peak(np.fft.irfft2(cross_power, s=reference.shape))
+
+
+def _crop(image: np.ndarray, top: int, left: int, size: int) -> np.ndarray:
+    """ size x size crop of an image, clamped to lie within it.
+    """
+    top = min(max(top, 0), image.shape[-2] - size)
+    left = min(max(left, 0), image.shape[-1] - size)
+    return image[..., top:top + size, left:left + size]
+
+
+def estimate_drift(stack: np.ndarray, reference: int = 0, factor: int = 4, refine_size: int = 256,
+                   batch_frames: int = 32, n_threads: int = None, progress=None, is_cancelled=None) -> np.ndarray:
+    """ Rigid drift of each frame of a stack relative to a reference frame.
+        Shifts are estimated on downsampled frames, then refined at full resolution by phase correlation of
+        a central crop of the reference with the correspondingly shifted crop of each frame.
+        Batches of frames are processed in parallel on a thread pool.
+    @param stack: (frames, height, width) stack
+    @param reference: index of the reference frame
+    @param factor: downsampling factor of the coarse estimate
+    @param refine_size: side of the full resolution crop (limited to the frame size)
+    @param batch_frames: frames per batch
+    @param n_threads: thread pool size, None for the number of CPUs.
+    @param progress: called with the fraction done (0 - 1), or None.
+    @param is_cancelled: called to check for cancellation, or None.
+    @return: (frames, 2) shifts (dy, dx), or None if cancelled.
+    """
+    height, width = stack.shape[1:3]
+    reference_frame = np.asarray(stack[reference], dtype=np.float32)
+    coarse_reference = downsample(reference_frame, factor)
+    size = min(refine_size, height, width)
+    top = (height - size) // 2
+    left = (width - size) // 2
+    fine_reference = _crop(reference_frame, top, left, size)
+    batches = [(start, min(start + batch_frames, stack.shape[0])) for start in range(0, stack.shape[0], batch_frames)]
+    done = [0]
+    lock = threading.Lock()
+
+    def estimate_batch(batch: tuple) -> np.ndarray:
+        if is_cancelled is not None and is_cancelled():
+            return None
+        frames = np.asarray(stack[batch[0]:batch[1]], dtype=np.float32)
+        coarse = np.round(phase_correlation(coarse_reference, downsample(frames, factor)) * factor).astype(int)
+        # refine: crop each frame where the reference crop should have moved to
+        crops = np.stack([_crop(frame, top + dy, left + dx, size) for frame, (dy, dx) in zip(frames, coarse)])
+        crop_offset = np.array([[min(max(top + dy, 0), height - size) - top, min(max(left + dx, 0), width - size) - left]
+                                for dy, dx in coarse])
+        shifts = crop_offset + phase_correlation(fine_reference, crops)
+        with lock:
+            done[0] += 1
+            if progress is not None:
+                progress(done[0] / len(batches))
+        return shifts
+
+    with ThreadPoolExecutor(max_workers=n_threads or os.cpu_count()) as pool:
+        results = list(pool.map(estimate_batch, batches))
+    if any(x is None for x in results):
+        return None
+    return np.concatenate(results)
+
+
+# ------------------------------------------------
+# Drift-corrected stack
+# ------------------------------------------------
+
+
+class DriftCorrectedStack:
+    """ Stack whose frames are shifted, when read, by a table of drift shifts (rounded to whole pixels).
+        Supports the indexing used on stacks: stack[frame], stack[start:stop] and
+        stack[start:stop, top:bottom, left:right]. Pixels shifted in from beyond the frame repeat the edge.
+    """
+
+    def __init__(self, stack: np.ndarray, shifts: np.ndarray):
+        """
+        @param stack: (frames, height, width) stack
+        @param shifts: (frames, 2) drift (dy, dx) of each frame, as from estimate_drift.
+        """
+        self.stack = stack
+        self.shifts = np.round(np.asarray(shifts)).astype(int)
+        self.shape = stack.shape
+        self.dtype = stack.dtype
+        self.ndim = stack.ndim
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def frame_region(self, frame: int, top: int, bottom: int, left: int, right: int) -> np.ndarray:
+        """ Region of a corrected frame: the source frame region displaced by the frame's drift.
+        """
+        dy, dx = self.shifts[frame]
+        height, width = self.shape[1:3]
+        source_top, source_left = top + dy, left + dx
+        read_top, read_bottom = min(max(source_top, 0), height - 1), min(max(bottom + dy, 1), height)
+        read_left, read_right = min(max(source_left, 0), width - 1), min(max(right + dx, 1), width)
+        values = np.asarray(self.stack[frame, read_top:read_bottom, read_left:read_right])
+        return np.pad(values, [(read_top - source_top, bottom + dy - read_bottom),
+                               (read_left - source_left, right + dx - read_right)], mode='edge')
+
+    def __getitem__(self, key):
+        keys = key if isinstance(key, tuple) else (key,)
+        keys = keys + (slice(None),) * (3 - len(keys))
+        rows = range(self.shape[1])[keys[1]]
+        columns = range(self.shape[2])[keys[2]]
+        if rows.step != 1 or columns.step != 1:
+            raise IndexError('Only unit-step row and column slices are supported.')
+        bounds = (rows.start, rows.stop, columns.start, columns.stop)
+        if isinstance(keys[0], slice):
+            frames = range(self.shape[0])[keys[0]]
+            return np.stack([self.frame_region(x, *bounds) for x in frames]) if len(frames) \
+                else np.zeros((0, len(rows), len(columns)), dtype=self.dtype)
+        return self.frame_region(range(self.shape[0])[keys[0]], *bounds)
+
+
+# ------------------------------------------------
+# ROI tracking
+# ------------------------------------------------
+
+
+def _gather_windows(frame: np.ndarray, tops: np.ndarray, lefts: np.ndarray, height: int, width: int) -> np.ndarray:
+    """ (n, height, width) windows of a frame at (top, left) positions, clamped to the frame edges.
+    """
+    rows = np.clip(tops[:, None] + np.arange(height), 0, frame.shape[0] - 1)
+    columns = np.clip(lefts[:, None] + np.arange(width), 0, frame.shape[1] - 1)
+    return np.asarray(frame[rows[:, :, None], columns[:, None, :]], dtype=np.float32)
+
+
+def normalized_cross_correlation(templates: np.ndarray, windows: np.ndarray) -> np.ndarray:
+    """ Normalized cross-correlation of templates at every position within larger search windows,
+        batched over templates. The correlation is computed with FFTs and the local window statistics with
+        integral images.
+    @param templates: (n, template height, template width)
+    @param windows: (n, window height, window width)
+    @return: (n, window height - template height + 1, window width - template width + 1) correlations
+    """
+    n, template_height, template_width = templates.shape
+    window_height, window_width = windows.shape[1:]
+    positions_y = window_height - template_height + 1
+    positions_x = window_width - template_width + 1
+    size = template_height * template_width
+    # zero-mean templates: the numerator is then the plain correlation with the window
+    zero_mean = templates - templates.mean(axis=(1, 2), keepdims=True)
+    template_norm = np.sqrt((zero_mean**2).sum(axis=(1, 2)))
+    correlation = np.fft.irfft2(np.fft.rfft2(windows) * np.conj(np.fft.rfft2(zero_mean, s=(window_height, window_width))),
+                                s=(window_height, window_width))[:, :positions_y, :positions_x]
+    # sums of window and window^2 over each template position
+    sums = []
+    for values in (windows, windows.astype(np.float64)**2):
+        integral = np.zeros((n, window_height + 1, window_width + 1))
+        integral[:, 1:, 1:] = values.cumsum(axis=1).cumsum(axis=2)
+        sums.append(integral[:, template_height:, template_width:] - integral[:, :positions_y, template_width:]
+                    - integral[:, template_height:, :positions_x] + integral[:, :positions_y, :positions_x])
+    window_norm = np.sqrt(np.maximum(sums[1] - sums[0]**2 / size, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nan_to_num(correlation / (window_norm * template_norm[:, None, None]))
+
+
+def track_rois(stack: np.ndarray, boxes: np.ndarray, reference: int = 0, search_radius: int = 10,
+               max_template: int = 64, progress=None, is_cancelled=None) -> np.ndarray:
+    """ Track regions through a stack by template matching.
+        Each region's template is taken from the reference frame; in every other frame it is found by
+        normalized cross-correlation within a search window around its position in the neighbouring frame,
+        working outwards from the reference. Regions with templates of the same size are matched at once for
+        each frame.
+    @param stack: (frames, height, width) stack
+    @param boxes: (n, 4) region bounding boxes in the reference frame: top, left, height, width.
+    @param reference: index of the reference frame
+    @param search_radius: largest movement between consecutive frames (pixels)
+    @param max_template: largest template side; larger regions are matched by their central part.
+    @param progress: called with the fraction done (0 - 1), or None.
+    @param is_cancelled: called to check for cancellation, or None.
+    @return: (frames, n, 2) offsets (dy, dx) of each region relative to the reference frame, or None if cancelled.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    n_frames = stack.shape[0]
+    offsets = np.zeros((n_frames, len(boxes), 2), dtype=int)
+    if len(boxes) == 0:
+        return offsets
+    # template of each region: its box (its central part if larger than max_template), centred on the region
+    sizes = np.clip(np.round(boxes[:, 2:4]), 1, max_template).astype(int)
+    tops = np.round(boxes[:, 0] + boxes[:, 2] / 2 - sizes[:, 0] / 2).astype(int)
+    lefts = np.round(boxes[:, 1] + boxes[:, 3] / 2 - sizes[:, 1] / 2).astype(int)
+    reference_frame = np.asarray(stack[reference])
+    # groups of regions with the same template size: (indices, template height, template width, templates)
+    groups = []
+    for template_height, template_width in np.unique(sizes, axis=0):
+        indices = np.flatnonzero(np.all(sizes == (template_height, template_width), axis=1))
+        templates = _gather_windows(reference_frame, tops[indices], lefts[indices], template_height, template_width)
+        groups.append((indices, template_height, template_width, templates))
+
+    order = list(range(reference + 1, n_frames)) + list(range(reference - 1, -1, -1))
+    for i, frame in enumerate(order):
+        if is_cancelled is not None and is_cancelled():
+            return None
+        previous = frame - 1 if frame > reference else frame + 1
+        values = np.asarray(stack[frame])
+        for indices, template_height, template_width, templates in groups:
+            window_tops = tops[indices] + offsets[previous, indices, 0] - search_radius
+            window_lefts = lefts[indices] + offsets[previous, indices, 1] - search_radius
+            windows = _gather_windows(values, window_tops, window_lefts,
+                                      template_height + 2 * search_radius, template_width + 2 * search_radius)
+            correlation = normalized_cross_correlation(templates, windows)
+            peak_y, peak_x = np.divmod(correlation.reshape(len(indices), -1).argmax(axis=1), correlation.shape[2])
+            offsets[frame, indices, 0] = offsets[previous, indices, 0] + peak_y - search_radius
+            offsets[frame, indices, 1] = offsets[previous, indices, 1] + peak_x - search_radius
+        if progress is not None:
+            progress((i + 1) / len(order))
+    return offsets
+    # common template size, centred on each region
+    template_height = int(min(max(boxes[:, 2].max(), 1), max_template))
+    template_width = int(min(max(boxes[:, 3].max(), 1), max_template))
+    tops = np.round(boxes[:, 0] + boxes[:, 2] / 2 - template_height / 2).astype(int)
+    lefts = np.round(boxes[:, 1] + boxes[:, 3] / 2 - template_width / 2).astype(int)
+    templates = _gather_windows(stack[reference], tops, lefts, template_height, template_width)
+
+    order = list(range(reference + 1, n_frames)) + list(range(reference - 1, -1, -1))
+    for i, frame in enumerate(order):
+        if is_cancelled is not None and is_cancelled():
+            return None
+        previous = frame - 1 if frame > reference else frame + 1
+        window_tops = tops + offsets[previous, :, 0] - search_radius
+        window_lefts = lefts + offsets[previous, :, 1] - search_radius
+        windows = _gather_windows(stack[frame], window_tops, window_lefts,
+                                  template_height + 2 * search_radius, template_width + 2 * search_radius)
+        correlation = normalized_cross_correlation(templates, windows)
+        peak_y, peak_x = np.divmod(correlation.reshape(len(boxes), -1).argmax(axis=1), correlation.shape[2])
+        offsets[frame, :, 0] = offsets[previous, :, 0] + peak_y - search_radius
+        offsets[frame, :, 1] = offsets[previous, :, 1] + peak_x - search_radius
+        if progress is not None:
+            progress((i + 1) / len(order))
+    return offsets
@@ -2,6 +2,10 @@
 # SOME COMMENTS  .......
 # ------------------------------------------------
 
+import os
+
+import numpy as np
+
 from SelectionRoi import (
     SelectionRoi,
     PointRoi,
@@ -10,25 +14,107 @@ from SelectionRoi import (
     EllipseRoi,
     RoiSelectionButton
 )
+from image_analysis import (
+    rgb_to_gray,
+    sample_values,
+    histogram_percentiles,
+    LabelStatistics,
+    detect_objects,
+    kymograph
+)
+from image_panels import (
+    LineProfileWindow,
+    HistogramWindow,
+    OverviewMap
+)
+from image_jobs import (
+    Job,
+    ProjectionJob,
+    ImageDecodeJob,
+    FileStackJob,
+    TiffStackJob,
+    DriftJob,
+    TrackingJob
+)
+from image_registration import DriftCorrectedStack
+from image_filters import FilterPipeline
+from tiff_stack import TiffStack
+from image_browser import (
+    ImageDecoder,
+    ThumbnailModel,
+    ThumbnailStrip,
+    list_images
+)
+from image_display import (
+    TileCache,
+    TiledLayer,
+    Channel,
+    ChannelCompositor,
+    LabelOverlay,
+    image_to_array,
+    image_to_rgb32,
+    rgb_to_image,
+    rgb32_to_image
+)
+from shared_arrays import (
+    SharedArray,
+    SharedArrayWatcher
+)
+from viewer_server import (
+    SERVER_NAME,
+    ViewerServer
+)
+from disk_cache import (
+    file_key,
+    load_array,
+    save_array_later
+)
+from roi_measurement import (
+    RoiIndexCache,
+    roi_time_series
+)
 
 from PyQt5.QtWidgets import (
     QWidget,
     QGraphicsView,
     QGraphicsScene,
+    QGraphicsSceneMouseEvent,
     QBoxLayout,
     QApplication,
     QHBoxLayout,
-    QPushButton
+    QPushButton,
+    QProgressDialog,
+    QStatusBar,
+    QCheckBox,
+    QShortcut
 )
 
 from PyQt5.QtCore import (
     Qt,
-    QRectF
+    QObject,
+    QEvent,
+    QRectF,
+    QRect,
+    QLineF,
+    QPointF,
+    QSize,
+    QTimer,
+    pyqtSignal
 )
 from PyQt5.QtGui import (
     QImage,
+    QImageReader,
+    QPixmap,
     QPainter,
-    QKeyEvent
+    QKeyEvent,
+    QKeySequence,
+    QCloseEvent,
+    QResizeEvent,
+    QTransform,
+    QPen,
+    QColor,
+    QFont,
+    QStaticText
 )
 
 # ------------------------------------------------
@@ -40,23 +126,398 @@ class ImageScene(QGraphicsScene):
     """ Graphics scene with image background and possibly ROIs.
     """
 
-    def __init__(self, image: QImage):
+    # emitted with the ROI whenever an ROI is moved or adjusted
+    roi_geometry_changed = pyqtSignal(object)
+    # emitted with the label clicked on the label overlay
+    label_clicked = pyqtSignal(int)
+    # emitted when the image, or how it is displayed, changes
+    image_changed = pyqtSignal()
+
+    def __init__(self, image: QImage, data: np.ndarray = None):
         """
         @param image: image to draw on scene.
+        @param data: pixel values that the image displays, if not the image itself (e.g. 16-bit or float data).
         """
         super().__init__(0, 0, image.width(), image.height())
-        # image
+        # image, and the size it is drawn at (larger than the image itself while it is a preview, see set_image)
         self.image = image
+        self.set_data(data)
+        self.image_width = image.width()
+        self.image_height = image.height()
+        # image file the image is of, if any, for the on-disk cache of its pyramid levels (see set_image)
+        self.source_path = None
+        # multi-channel composite, drawn instead of the image (see set_channels)
+        self.compositor = None
+        # label overlay, drawn over the image (see set_label_overlay)
+        self.label_overlay = None
+        # background pixmaps at power-of-two zoom levels <= 1, {level: QPixmap}
+        self.pixmaps = TileCache(max_items=8)
+        # scale (zoom) of the view and whether it is changing (see set_view_scale and set_interacting)
+        self.view_scale = 1.0
+        self.is_interacting = False
+        # scale from which a pixel grid and the pixel values are drawn (None for never), and the text layouts
+        # of the values, {(text, font key): QStaticText}
+        self.pixel_grid_scale = 20.0
+        self.value_texts = TileCache(max_items=4096)
+        # shared memory array shown, and the watcher of its changes (see attach_shared)
+        self.shared = None
+        self.shared_watcher = None
         # ROIs
         self.rois = []
+        # ROI pixel indices, dropped when an ROI changes
+        self.roi_index_cache = RoiIndexCache()
+        self.roi_geometry_changed.connect(self.roi_index_cache.invalidate)
         # hide/show anchors according to ROI focus
         self.selectionChanged.connect(self.change_selected_item)
 
     def drawBackground(self, painter: QPainter, rect: QRectF):
         """ Overrides QGraphicsScene::drawBackground, so image will be drawn on scene.
+            The image is drawn from a pixmap cached for the zoom level; a multi-channel composite is drawn
+            tile by tile, for the tiles within the exposed rect only. While the view is being zoomed or panned
+            pixmaps are scaled by nearest neighbour; otherwise smoothly, up to the scale of the pixel grid.
+            The zoom level is that of the painter, as the scene may be shown by several views at different zooms.
+        """
+        scale = painter.transform().map(QLineF(0, 0, 1, 0)).length()
+        show_grid = self.pixel_grid_scale is not None and scale >= self.pixel_grid_scale
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, not self.is_interacting and not show_grid)
+        if self.compositor is None:
+            bounds = QRectF(0, 0, self.image_width, self.image_height)
+            target = rect.intersected(bounds)
+            pixmap = self.background_pixmap(scale)
+            ratio = pixmap.width() / max(self.image_width, 1)
+            source = QRectF(target.x() * ratio, target.y() * ratio, target.width() * ratio, target.height() * ratio)
+            painter.drawPixmap(target, pixmap, source)
+        else:
+            ImageScene.draw_tiles(painter, rect, self.compositor)
+        if self.label_overlay is not None:
+            painter.save()
+            painter.setOpacity(self.label_overlay.opacity)
+            ImageScene.draw_tiles(painter, rect, self.label_overlay)
+            painter.restore()
+        if show_grid:
+            self.draw_pixel_grid(painter, rect)
+
+    def draw_pixel_grid(self, painter: QPainter, rect: QRectF):
+        """ Draw a grid around the pixels within a rect, and each pixel's value(s) within it.
+            Only the pixels within the rect are drawn, and the text layout of each value is cached, so the cost
+            depends on the size of the view, not of the image.
+        """
+        bounds = rect.intersected(QRectF(0, 0, self.image_width, self.image_height))
+        if bounds.isEmpty():
+            return
+        left, top = int(np.floor(bounds.left())), int(np.floor(bounds.top()))
+        right, bottom = int(np.ceil(bounds.right())), int(np.ceil(bounds.bottom()))
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing, False)
+        painter.setPen(QPen(QColor(128, 128, 128, 160), 0))
+        painter.drawLines([QLineF(x, top, x, bottom) for x in range(left, right + 1)] +
+                          [QLineF(left, y, right, y) for y in range(top, bottom + 1)])
+
+        values = self.pixel_block(top, bottom, left, right)
+        if values is not None:
+            texts = [[[ImageScene.format_value(x) for x in pixel] for pixel in row] for row in values]
+            # font size to fit the longest value across a cell, and the lines of a pixel's values within it
+            transform = painter.transform()
+            cell = transform.map(QLineF(0, 0, 1, 0)).length()
+            n_characters = max(len(x) for row in texts for pixel in row for x in pixel)
+            font_size = int(min(cell / (0.65 * n_characters + 1), cell / (values.shape[2] + 1)))
+            if font_size >= 5:
+                brightness = self.display_brightness(top, bottom, left, right)
+                font = painter.font()
+                font.setPixelSize(font_size)
+                painter.setFont(font)
+                painter.resetTransform()
+                line_height = 1.2 * font_size
+                for i, row in enumerate(texts):
+                    for j, pixel in enumerate(row):
+                        painter.setPen(Qt.black if brightness[i, j] > 0.5 else Qt.white)
+                        center = transform.map(QPointF(left + j + 0.5, top + i + 0.5))
+                        y = center.y() - line_height * len(pixel) / 2
+                        for text in pixel:
+                            static_text = self.value_text(text, font)
+                            painter.drawStaticText(QPointF(center.x() - static_text.size().width() / 2, y),
+                                                   static_text)
+                            y += line_height
+        painter.restore()
+
+    def value_text(self, text: str, font: QFont) -> QStaticText:
+        """ Cached text layout of a pixel value, laid out in the font it is drawn in (so its size is known).
+        """
+        static_text = self.value_texts.get((text, font.key()))
+        if static_text is None:
+            static_text = QStaticText(text)
+            static_text.setTextFormat(Qt.PlainText)
+            static_text.prepare(QTransform(), font)
+            self.value_texts.put((text, font.key()), static_text)
+        return static_text
+
+    @staticmethod
+    def format_value(value) -> str:
+        """ Text of a pixel value: integers exactly, other values to 6 significant figures.
+        """
+        return str(value) if isinstance(value, (int, np.integer)) else '{:.6g}'.format(value)
+
+    @staticmethod
+    def draw_tiles(painter: QPainter, rect: QRectF, layer: TiledLayer):
+        """ Draw the tiles of a tiled layer that are within a rect.
+        """
+        tile_rows, tile_columns = layer.tile_range(rect.top(), rect.bottom(), rect.left(), rect.right())
+        for row in tile_rows:
+            for column in tile_columns:
+                top, bottom, left, right = layer.tile_bounds(row, column)
+                painter.drawPixmap(QRectF(left, top, right - left, bottom - top), layer.tile(row, column),
+                                   QRectF(0, 0, right - left, bottom - top))
+
+    def background_pixmap(self, scale: float = None) -> QPixmap:
+        """ Pixmap of the image for a zoom level.
+            Below a scale of 1, the image is smoothly scaled (once) to the power-of-two level at or above the
+            view scale, so painting it needs at most a 2x reduction. A preview is only reduced below its own size.
+        @param scale: scale of the view, None for the scale set by set_view_scale.
+        """
+        scale = self.view_scale if scale is None else scale
+        level = 1.0
+        while level / 2 >= scale and level > 1 / 64:
+            level /= 2
+        pixmap = self.pixmaps.get(level)
+        if pixmap is None:
+            pixmap = QPixmap.fromImage(self.level_image(level))
+            self.pixmaps.put(level, pixmap)
+        return pixmap
+
+    def level_image(self, level: float) -> QImage:
+        """ The image reduced to a pyramid level (a fraction of its full size).
+            Levels of an image file are kept in the on-disk cache, keyed by the file's identity and the image
+            size, so they are not computed again when the file is reopened; a cached level is used even while
+            the image is a preview, as it is better than the preview.
+        """
+        width = max(1, int(self.image_width * level))
+        height = max(1, int(self.image_height * level))
+        key = None
+        if self.source_path is not None and level < 1:
+            try:
+                key = file_key(self.source_path, self.image_width, self.image_height, level)
+            except OSError:
+                pass
+            else:
+                pixels = load_array('pyramid', key)
+                if pixels is not None and pixels.shape[:2] == (height, width):
+                    return rgb32_to_image(pixels)
+        if width >= self.image.width():
+            return self.image
+        image = self.image.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        if key is not None and not self.is_preview():
+            save_array_later('pyramid', key, image_to_rgb32(image))
+        return image
+
+    def set_view_scale(self, scale: float):
+        """ Set the scale (zoom) of the view, for the sizes of ROI lines/anchors and background pixmaps.
+        """
+        self.view_scale = scale
+        self.adjust_roi_scale(scale)
+
+    def set_interacting(self, is_interacting: bool):
+        """ Set whether the view is being zoomed or panned (fast drawing) or is idle (smooth drawing).
+        """
+        if is_interacting != self.is_interacting:
+            self.is_interacting = is_interacting
+            if not is_interacting:
+                self.update()
+
+    # ------------------------------------------------
+    # Channels
+    # ------------------------------------------------
+
+    def set_channels(self, channels: list):
+        """ Show an additive composite of channels instead of the image.
+        @param channels: channels, all of the same shape. The first channel's data are the image data.
         """
-        bounds = QRectF(0, 0, self.image.width(), self.image.height())
-        painter.drawImage(bounds, image)
+        self.compositor = ChannelCompositor(channels)
+        self._image_array = channels[0].data
+        self.image_height, self.image_width = self.compositor.shape
+        self.setSceneRect(0, 0, self.compositor.shape[1], self.compositor.shape[0])
+        self.update()
+        self.image_changed.emit()
+
+    def set_channel_data(self, index: int, data: np.ndarray):
+        """ Replace the data of a channel (e.g. for a new frame of a stack), keeping its display settings.
+        """
+        self.compositor.channels[index].data = data
+        if index == 0:
+            self._image_array = data
+        self.compositor.channel_changed(index)
+        self.update()
+        self.image_changed.emit()
+
+    def set_channel_visible(self, index: int, visible: bool):
+        self.compositor.set_visible(index, visible)
+        self.update()
+        self.image_changed.emit()
+
+    def set_channel_window(self, index: int, low: float, high: float):
+        self.compositor.set_window(index, low, high)
+        self.update()
+        self.image_changed.emit()
+
+    def set_channel_color(self, index: int, color: tuple):
+        self.compositor.set_color(index, color)
+        self.update()
+        self.image_changed.emit()
+
+    # ------------------------------------------------
+    # Shared memory
+    # ------------------------------------------------
+
+    def attach_shared(self, name: str, shape: tuple, dtype, interval: int = 50) -> SharedArray:
+        """ Show an array in a shared memory block of another process (e.g. an analysis process), without copying
+            it. The array is redrawn whenever the producer marks it as changed (see SharedArray.mark_changed).
+        @param name: block name
+        @param shape: (height, width) array shape
+        @param dtype: array type
+        @param interval: interval at which to check for changes (ms)
+        @return: the shared array
+        @raise FileNotFoundError: if there is no such block.
+        """
+        shared = SharedArray.attach(name, shape, dtype)
+        self.set_channels([Channel(shared.array)])
+        self.watch_shared(shared, lambda: self.set_channel_data(0, shared.array), interval)
+        return shared
+
+    def watch_shared(self, shared: SharedArray, changed, interval: int = 50):
+        """ Call changed whenever a shared array shown on the scene is marked as changed.
+            Replaces the shared array watched before, if any.
+        """
+        self.detach_shared()
+        self.shared = shared
+        self.shared_watcher = SharedArrayWatcher(shared, interval, self)
+        self.shared_watcher.changed.connect(changed)
+
+    def detach_shared(self):
+        """ Stop watching the shared array. Its block stays mapped while its data are still shown.
+        """
+        if self.shared_watcher is not None:
+            self.shared_watcher.stop()
+            self.shared_watcher.deleteLater()
+        self.shared = None
+        self.shared_watcher = None
+
+    # ------------------------------------------------
+    # Filters
+    # ------------------------------------------------
+
+    def set_filters(self, filters: list, index: int = 0) -> FilterPipeline:
+        """ Filter a channel (or the image) for display.
+            Filters are evaluated lazily on the tiles that are drawn; the channel window is reset to the
+            range of the filtered central tile.
+        @param filters: image_filters.ImageFilter objects, applied in order.
+        @param index: channel
+        @return: the filter pipeline; call filters_changed() after changing its filters' parameters.
+                 None while the image is a preview.
+        """
+        if self.compositor is None:
+            if self.is_preview():
+                return None
+            self.set_channels([Channel(self.image_array())])
+        pipeline = FilterPipeline(filters)
+        self.compositor.set_filters(index, pipeline)
+        # window from the central tile
+        tile_rows, tile_columns = self.compositor.tile_range(self.height() / 2, self.height() / 2 + 1,
+                                                             self.width() / 2, self.width() / 2 + 1)
+        values = self.compositor.channels[index].values(*self.compositor.tile_bounds(tile_rows[0], tile_columns[0]))
+        self.compositor.set_window(index, float(np.min(values)), float(np.max(values)))
+        self.update()
+        self.image_changed.emit()
+        return pipeline
+
+    def auto_contrast(self, region: QRectF = None, low: float = 0.1, high: float = 99.9, index: int = None):
+        """ Set the window of each channel (or of the image) to percentiles of its values, so e.g. the darkest
+            and brightest 0.1% are saturated. The percentiles are estimated from the histogram of a regular sample
+            of the data, which takes milliseconds however large the image. An image without channels is shown as
+            channels (one, or red, green and blue) so that it can be windowed.
+        @param region: region (in image coordinates) to take the values from, e.g. the part of the scene in view;
+                       None for the whole image.
+        @param low: percentile shown as black
+        @param high: percentile shown at full color
+        @param index: channel, None for all channels.
+        """
+        if self.compositor is None:
+            if self.is_preview():
+                return
+            if self._pixels is None:
+                self._pixels = image_to_array(self.image)
+            if self._pixels.ndim == 3:
+                # the channels are for display only: the image data (e.g. measured by ROIs) stay the gray values
+                data = self.image_array()
+                colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+                self.set_channels([Channel(self._pixels[:, :, i], colors[i]) for i in range(3)])
+                self._image_array = data
+            else:
+                self.set_channels([Channel(self._pixels)])
+        if region is None:
+            bounds = (0, self.image_height, 0, self.image_width)
+        else:
+            region = region.intersected(QRectF(0, 0, self.image_width, self.image_height)).toAlignedRect()
+            if region.isEmpty():
+                return
+            bounds = (region.top(), region.top() + region.height(), region.left(), region.left() + region.width())
+        for i in range(len(self.compositor.channels)) if index is None else [index]:
+            channel = self.compositor.channels[i]
+            if channel.filters is None or not channel.filters.filters:
+                values = sample_values(channel.data, *bounds)
+            else:
+                # filtered values: of the region if given, otherwise of the central tile (filtering the whole
+                # image would take too long)
+                channel_bounds = bounds
+                if region is None:
+                    center_y, center_x = self.image_height / 2, self.image_width / 2
+                    tile_rows, tile_columns = self.compositor.tile_range(center_y, center_y + 1, center_x, center_x + 1)
+                    channel_bounds = self.compositor.tile_bounds(tile_rows[0], tile_columns[0])
+                values = sample_values(channel.values(*channel_bounds))
+            window_low, window_high = histogram_percentiles(values, [low, high])
+            self.compositor.set_window(i, window_low, window_high)
+        self.update()
+        self.image_changed.emit()
+
+    def filters_changed(self, index: int = 0):
+        """ Redraw a channel after a change to its filters' parameters. Only the tiles that are drawn are
+            filtered again.
+        """
+        self.compositor.channel_changed(index)
+        self.update()
+        self.image_changed.emit()
+
+    # ------------------------------------------------
+    # Label overlay
+    # ------------------------------------------------
+
+    def set_label_overlay(self, labels: np.ndarray, opacity: float = 0.5) -> LabelStatistics:
+        """ Overlay a label image (e.g. a segmentation) on the image.
+        @param labels: (height, width) uint16 or uint32 label image; 0 is background.
+        @param opacity: opacity of the overlay
+        @return: statistics of the labels, with mean intensities of the image data.
+        """
+        data = self.image_array()
+        statistics = LabelStatistics(labels, data if data is not None and data.shape == labels.shape else None)
+        self.label_overlay = LabelOverlay(labels, statistics, opacity)
+        self.update()
+        return statistics
+
+    def set_label_opacity(self, opacity: float):
+        self.label_overlay.opacity = opacity
+        self.update()
+
+    def mousePressEvent(self, event: QGraphicsSceneMouseEvent):
+        """ Clicking on the label overlay, away from any ROI, highlights the label under the mouse.
+            Overrides QGraphicsScene::mousePressEvent
+        """
+        super().mousePressEvent(event)
+        if self.label_overlay is None or self.itemAt(event.scenePos(), QTransform()) is not None:
+            return
+        x, y = int(event.scenePos().x()), int(event.scenePos().y())
+        if 0 <= y < self.label_overlay.shape[0] and 0 <= x < self.label_overlay.shape[1]:
+            label = int(self.label_overlay.labels[y, x])
+            self.label_overlay.highlight(label)
+            self.update()
+            self.label_clicked.emit(label)
 
     def add_roi(self, roi: SelectionRoi):
         """ Add an ROI
@@ -64,6 +525,157 @@ class ImageScene(QGraphicsScene):
         self.rois.append(roi)
         self.addItem(roi)
 
+    def add_rois(self, rois: list):
+        """ Add many ROIs at once.
+            The scene index is switched off while the items are added and rebuilt once at the end,
+            rather than being updated for every item.
+        """
+        index_method = self.itemIndexMethod()
+        self.setItemIndexMethod(QGraphicsScene.NoIndex)
+        for roi in rois:
+            self.rois.append(roi)
+            self.addItem(roi)
+        self.setItemIndexMethod(index_method)
+
+    def clear_rois(self):
+        """ Remove all ROIs.
+        """
+        for roi in self.rois:
+            self.removeItem(roi)
+        self.rois = []
+        self.roi_index_cache.clear()
+
+    def set_image(self, image: QImage, data: np.ndarray = None, size: QSize = None, source_path: str = None):
+        """ Replace the image (e.g. for a new frame of a stack).
+        @param image: image to draw on scene.
+        @param data: pixel values that the image displays, if not the image itself.
+        @param size: size to draw the image at, if not its own size: the full size of an image of which
+                     this is a reduced preview. The scene is in full-size image coordinates either way.
+        @param source_path: image file that the image is (a preview) of, if any, for the on-disk cache of its
+                            pyramid levels.
+        """
+        self.image = image
+        self.set_data(data)
+        self.image_width = image.width() if size is None else size.width()
+        self.image_height = image.height() if size is None else size.height()
+        self.source_path = source_path
+        self.compositor = None
+        self.pixmaps.clear()
+        self.setSceneRect(0, 0, self.image_width, self.image_height)
+        self.update()
+        self.image_changed.emit()
+
+    def set_data(self, data: np.ndarray):
+        """ Set the pixel values that the image displays. The values of RGB data are their gray values
+            (see rgb_to_gray), e.g. for measurement; the RGB values are kept for display and pixel readout.
+        @param data: (height, width) or (height, width, 3) RGB array, or None for the image itself.
+        """
+        self._pixels = data
+        self._image_array = rgb_to_gray(data) if data is not None and data.ndim == 3 else data
+
+    def is_preview(self) -> bool:
+        """ Whether the image is a reduced preview of the full image.
+        """
+        return self.image.width() != self.image_width or self.image.height() != self.image_height
+
+    @staticmethod
+    def array_to_image(array: np.ndarray, low: float = None, high: float = None) -> QImage:
+        """ 8-bit image of an array, with values scaled so that low -> 0 and high -> 255.
+        @param array: (height, width) grayscale or (height, width, 3) RGB array.
+        @param low: value shown as black, None for the array minimum.
+        @param high: value shown as white, None for the array maximum.
+        @return: image
+        """
+        low = float(np.min(array)) if low is None else low
+        high = float(np.max(array)) if high is None else high
+        scaled = (array.astype(np.float32) - low) * (255 / max(high - low, 1e-12))
+        pixels = np.ascontiguousarray(np.clip(scaled, 0, 255).astype(np.uint8))
+        image_format = QImage.Format_RGB888 if pixels.ndim == 3 else QImage.Format_Grayscale8
+        image = QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.strides[0], image_format)
+        return image.copy()
+
+    def image_array(self) -> np.ndarray:
+        """ Pixel values of the image: the data (gray values of RGB data), if given, otherwise the grayscale
+            image as a (height, width) uint8 array; None while the image is a preview, as the preview's pixels
+            are not at image coordinates.
+        """
+        if self._image_array is None:
+            if self.is_preview():
+                return None
+            gray = self.image.convertToFormat(QImage.Format_Grayscale8)
+            bits = gray.constBits()
+            bits.setsize(gray.bytesPerLine() * gray.height())
+            rows = np.frombuffer(bits, dtype=np.uint8).reshape(gray.height(), gray.bytesPerLine())
+            self._image_array = rows[:, :gray.width()].copy()
+        return self._image_array
+
+    def pixel_values(self, x: float, y: float) -> tuple:
+        """ Values of the pixel at a scene position, read from the source data (so 16-bit and float data are
+            exact): the value of each channel of a multi-channel image, the data value(s) if the image displays
+            data, otherwise the image's gray or RGB value.
+        @return: values, or None if the position is outside the image (or the image is a preview).
+        """
+        row, column = int(np.floor(y)), int(np.floor(x))
+        if not (0 <= row < self.image_height and 0 <= column < self.image_width):
+            return None
+        if self.compositor is not None:
+            return tuple(channel.data[row, column] for channel in self.compositor.channels)
+        if self.is_preview():
+            return None
+        if self._pixels is None:
+            self._pixels = image_to_array(self.image)
+        return tuple(np.atleast_1d(self._pixels[row, column]))
+
+    def overview_image(self, max_size: int = 200) -> QImage:
+        """ Image of the whole scene image reduced to at most max_size (width and height), e.g. for an overview.
+            The image is reduced from a pyramid level; a composite is made from channel data sampled on a grid
+            (unfiltered), so only about max_size^2 pixels of each channel are read.
+        """
+        level = 1.0
+        while max(self.image_width, self.image_height) * level > max_size and level > 1 / 4096:
+            level /= 2
+        if self.compositor is None:
+            image = self.level_image(level)
+        else:
+            step = int(round(1 / level))
+            total = np.zeros(((self.image_height + step - 1) // step, (self.image_width + step - 1) // step, 3),
+                             dtype=np.uint16)
+            for channel in self.compositor.channels:
+                if channel.visible:
+                    total += channel.to_rgb(np.asarray(channel.data[::step, ::step]))
+            image = rgb_to_image(np.minimum(total, 255).astype(np.uint8))
+        return image.scaled(max_size, max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    def pixel_block(self, top: int, bottom: int, left: int, right: int) -> np.ndarray:
+        """ Values of the pixels of a region, read from the source data (see pixel_values).
+        @return: (height, width, values per pixel) array, or None while the image is a preview.
+        """
+        if self.compositor is not None:
+            return np.stack([np.asarray(x.data[top:bottom, left:right]) for x in self.compositor.channels], axis=-1)
+        if self.is_preview():
+            return None
+        if self._pixels is None:
+            self._pixels = image_to_array(self.image)
+        block = np.asarray(self._pixels[top:bottom, left:right])
+        return block if block.ndim == 3 else block[:, :, None]
+
+    def display_brightness(self, top: int, bottom: int, left: int, right: int) -> np.ndarray:
+        """ Brightness (0 to 1) of the pixels of a region as displayed, e.g. to choose a color of text drawn over them.
+        @return: (height, width) array
+        """
+        if self.compositor is not None:
+            brightness = np.zeros((bottom - top, right - left), dtype=np.float32)
+            for channel in self.compositor.channels:
+                if channel.visible:
+                    values = channel.scale(channel.values(top, bottom, left, right))
+                    brightness = np.maximum(brightness, values * max(channel.color) / 255)
+            return brightness
+        gray = self.image.copy(QRect(left, top, right - left, bottom - top)).convertToFormat(QImage.Format_Grayscale8)
+        bits = gray.constBits()
+        bits.setsize(gray.bytesPerLine() * gray.height())
+        rows = np.frombuffer(bits, dtype=np.uint8).reshape(gray.height(), gray.bytesPerLine())
+        return rows[:, :gray.width()] / 255
+
     def adjust_roi_scale(self, scale: float):
         for roi in self.rois:
             roi.set_to_scale(scale)
@@ -91,10 +703,21 @@ class ImageMenu(QWidget):
         # roi selection
         self.roi_button = RoiSelectionButton(self)
 
+        # automatic ROI detection
+        self.detect_button = QPushButton('Detect', self)
+
+        # automatic contrast, of the whole image or the part in view
+        self.auto_button = QPushButton('Auto', self)
+        self.auto_in_view_box = QCheckBox('In view', self)
+
         # layout
         layout = QBoxLayout(QBoxLayout.LeftToRight)
         layout.setContentsMargins(0, 0, 0, 0)
         layout.addWidget(self.roi_button)
+        layout.addWidget(self.detect_button)
+        layout.addWidget(self.auto_button)
+        layout.addWidget(self.auto_in_view_box)
+        layout.addStretch()
         layout.setAlignment(self.roi_button, Qt.AlignLeft)
         self.setLayout(layout)
         self.adjustSize()
@@ -105,62 +728,840 @@ class ImageViewer(QWidget):
     """ Image with graphics scene to allow drawing of ROIs
     """
 
-    def __init__(self, image: QImage):
+    # emitted with the region of the image in view whenever the view is zoomed or panned
+    view_changed = pyqtSignal(QRectF)
+    # emitted with the frame whenever a frame of the stack is shown
+    frame_changed = pyqtSignal(int)
+    # emitted with the stack (or None) whenever a stack is set or removed
+    stack_changed = pyqtSignal(object)
+
+    def __init__(self, image: QImage, data: np.ndarray = None, example_rois: bool = True,
+                 scene: ImageScene = None):
         """
         @param image: image to show
+        @param data: pixel values that the image displays, if not the image itself.
+        @param example_rois: add example ROIs.
+        @param scene: scene to show, shared with other viewers (see open_linked_view); image and data are
+                      then ignored.
         """
 
         # GUI constructor
         super().__init__()
 
         # graphics scene
-        self.scene = ImageScene(image)
+        self.scene = ImageScene(image, data) if scene is None else scene
+
+        # stack of frames (see set_stack)
+        self.stack = None
+        self.frame = 0
 
         # ROIs
-        self.scene.add_roi(RectangleRoi(50, 10, 50, 40))
-        self.scene.add_roi(RectangleRoi(100, 50, 100, 20))
-        self.scene.add_roi(EllipseRoi(75, 20, 60, 20))
-        self.scene.rois[-1].set_properties(color_rgb=[255, 0, 0], line_width=6.0)
-        self.scene.add_roi(EllipseRoi(120, 70, 8, 8))
-        self.scene.add_roi(PathRoi([10, 60], [10, 50], is_closed=False, is_anchored=True))
-        self.scene.rois[-1].set_properties(color_rgb=[30, 255, 0], line_width=6.0)
-        self.scene.add_roi(PathRoi([60, 65, 75], [60, 76, 50], is_closed=True, is_anchored=True))
-        self.scene.add_roi(PointRoi(120, 50, size=6))
+        self.line_roi = None
+        if example_rois:
+            self.add_example_rois()
 
         # graphics view
         self.viewer = QGraphicsView(self.scene)
         self.viewer.setSceneRect(0, 0, self.scene.width(), self.scene.height())
+        self.scene.sceneRectChanged.connect(self.scene_rect_changed)
         self.viewer.setInteractive(True)
+        # drop files onto the view to open them; readout of the pixel under the mouse
+        self.viewer.setAcceptDrops(True)
+        self.viewer.viewport().setMouseTracking(True)
+        self.viewer.viewport().installEventFilter(self)
         self.viewer.show()
         self.scale = 1.0
 
+        # fast drawing while zooming/panning; a smooth redraw once the view has been idle for a while
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(150)
+        self.idle_timer.timeout.connect(lambda: self.scene.set_interacting(False))
+
+        # pixel readout, updated at most once per frame (16 ms) however often the mouse moves
+        self.status_bar = QStatusBar(self)
+        self.status_bar.setSizeGripEnabled(False)
+        self.hover_position = None
+        self.readout_timer = QTimer(self)
+        self.readout_timer.setSingleShot(True)
+        self.readout_timer.setInterval(16)
+        self.readout_timer.timeout.connect(self.update_readout)
+        self.viewer.horizontalScrollBar().valueChanged.connect(self.view_changing)
+        self.viewer.verticalScrollBar().valueChanged.connect(self.view_changing)
+
+        # measurement windows and viewers opened from this viewer, and running background jobs
+        self.windows = []
+        self.jobs = []
+
+        # image file being shown (see load_image), and the files of a directory being browsed (see open_directory)
+        self.image_path = None
+        self.files = []
+        self.file_index = 0
+        self.prefetch_count = 0
+        self.decoder = None
+        self.thumbnail_strip = None
+
+        # command server (see listen)
+        self.server = None
+
+        # whether the view is following another, linked view (see link_view)
+        self.is_following = False
+
+        # overview for navigation, over the top right corner of the view (see show_overview)
+        self.overview = OverviewMap(self.scene, parent=self)
+        self.overview.hide()
+        self.overview.navigated.connect(self.viewer.centerOn)
+        self.view_changed.connect(self.overview.set_region)
+
         # menu
         self.menu = ImageMenu(self)
+        self.menu.detect_button.clicked.connect(lambda: self.detect_rois())
+        self.menu.auto_button.clicked.connect(lambda: self.auto_contrast(self.menu.auto_in_view_box.isChecked()))
 
         # layout
         layout = QBoxLayout(QBoxLayout.TopToBottom)
         layout.setContentsMargins(0, 0, 0, 0)
         layout.addWidget(self.menu)
         layout.addWidget(self.viewer)
+        layout.addWidget(self.status_bar)
         self.setLayout(layout)
 
         #self.resize(self.scene.width(), self.scene.height())
 
+    def add_example_rois(self):
+        """ Add one of each type of ROI. The green open path is the line ROI.
+        """
+        self.scene.add_roi(RectangleRoi(50, 10, 50, 40))
+        self.scene.add_roi(RectangleRoi(100, 50, 100, 20))
+        self.scene.add_roi(EllipseRoi(75, 20, 60, 20))
+        self.scene.rois[-1].set_properties(color_rgb=[255, 0, 0], line_width=6.0)
+        self.scene.add_roi(EllipseRoi(120, 70, 8, 8))
+        self.scene.add_roi(PathRoi([10, 60], [10, 50], is_closed=False, is_anchored=True))
+        self.scene.rois[-1].set_properties(color_rgb=[30, 255, 0], line_width=6.0)
+        self.line_roi = self.scene.rois[-1]
+        self.scene.add_roi(PathRoi([60, 65, 75], [60, 76, 50], is_closed=True, is_anchored=True))
+        self.scene.add_roi(PointRoi(120, 50, size=6))
+
     def keyPressEvent(self, event: QKeyEvent):
-        """ Zoom in and out (+ and - keys).
+        """ Zoom in and out (+ and - keys). Line profile (P key) and kymograph (K key) of the selected
+            path ROI, histogram of the view (H key), another view of the scene, linked to this one (L key),
+            overview of the image (O key). Previous and next frame of a stack ([ and ] keys), maximum projection
+            of the stack (Z key), drift correction of the stack (D key), tracking of ROIs through the stack (T key).
+            Show/hide channels (number keys). See open_directory for the previous and next file keys.
             Overrides QGraphicsView::keyPressEvent
         """
-        if event.key() == Qt.Key_Plus or event.key() == Qt.Key_Minus:
-            if event.key() == Qt.Key_Plus:
-                self.scale *= 1.2
-            else:
-                self.scale /= 1.2
-            self.viewer.resetTransform()
-            self.viewer.scale(self.scale, self.scale)
-            self.scene.adjust_roi_scale(self.scale)
+        if Qt.Key_1 <= event.key() <= Qt.Key_9:
+            self.toggle_channel(event.key() - Qt.Key_1)
+        elif event.key() == Qt.Key_P:
+            self.show_line_profile()
+        elif event.key() == Qt.Key_H:
+            self.show_histogram()
+        elif event.key() == Qt.Key_L:
+            self.open_linked_view()
+        elif event.key() == Qt.Key_O:
+            self.show_overview(not self.overview.isVisible())
+        elif event.key() == Qt.Key_K:
+            self.show_kymograph()
+        elif event.key() == Qt.Key_Z:
+            self.show_projection()
+        elif event.key() == Qt.Key_D:
+            self.correct_drift()
+        elif event.key() == Qt.Key_T:
+            self.track_rois()
+        elif event.key() == Qt.Key_BracketLeft or event.key() == Qt.Key_BracketRight:
+            self.set_frame(self.frame + (1 if event.key() == Qt.Key_BracketRight else -1))
+        elif event.key() == Qt.Key_Plus or event.key() == Qt.Key_Minus:
+            self.set_scale(self.scale * (1.2 if event.key() == Qt.Key_Plus else 1 / 1.2))
 
         event.accept()
 
+    def scene_rect_changed(self, rect: QRectF):
+        """ Slot for changes to the scene size (e.g. a new image). Not connected to the view itself, as a slot of
+            this viewer is disconnected when it is deleted, while the scene may be shared with other viewers.
+        """
+        self.viewer.setSceneRect(rect)
+
+    def set_scale(self, scale: float):
+        """ Zoom the view.
+        """
+        self.scale = scale
+        self.viewer.resetTransform()
+        self.viewer.scale(self.scale, self.scale)
+        self.scene.set_view_scale(self.scale)
+        self.view_changing()
+
+    def view_changing(self):
+        """ Slot for zooming and panning: draw fast until the view is idle.
+        """
+        self.scene.set_interacting(True)
+        self.idle_timer.start()
+        self.view_changed.emit(self.view_region())
+
+    def resizeEvent(self, event: QResizeEvent):
+        """ Overrides QWidget::resizeEvent
+        """
+        super().resizeEvent(event)
+        self.place_overview()
+        self.view_changed.emit(self.view_region())
+
+    def show_overview(self, show: bool = True):
+        """ Show or hide the overview of the image.
+        """
+        self.overview.setVisible(show)
+        if show:
+            self.overview.set_region(self.view_region())
+            self.place_overview()
+
+    def place_overview(self):
+        """ Keep the overview over the top right corner of the view (clear of the scroll bar).
+        """
+        view = self.viewer.geometry()
+        margin = self.viewer.verticalScrollBar().width() if self.viewer.verticalScrollBar().isVisible() else 0
+        self.overview.move(view.right() - margin - self.overview.width() - 4, view.top() + 4)
+        self.overview.raise_()
+
+    def view_region(self) -> QRectF:
+        """ Region of the scene (image coordinates) in view.
+        """
+        return self.viewer.mapToScene(self.viewer.viewport().rect()).boundingRect()
+
+    # ------------------------------------------------
+    # Line profile
+    # ------------------------------------------------
+
+    def selected_path_roi(self) -> PathRoi:
+        """ The selected open path ROI, or the line ROI if no such ROI is selected.
+        """
+        selected_items = self.scene.selectedItems()
+        for roi in self.scene.rois:
+            if isinstance(roi, PathRoi) and not roi.is_closed and any(roi.has_item(x) for x in selected_items):
+                return roi
+        return self.line_roi
+
+    def show_line_profile(self, roi: PathRoi = None, width: float = 1.0) -> LineProfileWindow:
+        """ Open a live intensity profile along a path ROI.
+        @param roi: path ROI. If None, the selected open path ROI (or the line ROI).
+        @param width: width of the line (pixels), averaged across.
+        @return: the profile window, or None if there is no path ROI (or the image is a preview).
+        """
+        if roi is None:
+            roi = self.selected_path_roi()
+        array = self.scene.image_array()
+        if roi is None or array is None:
+            return None
+        window = LineProfileWindow(self.scene, array, roi, width=width)
+        window.show()
+        self.add_window(window)
+        return window
+
+    def show_histogram(self) -> HistogramWindow:
+        """ Open a live histogram of the part of the image (or frame) in view, following changes to the image.
+        @return: the histogram window, or None while the image is a preview.
+        """
+        array = self.scene.image_array()
+        if array is None:
+            return None
+        window = HistogramWindow(array, scene=self.scene)
+        window.set_region(self.view_region())
+        self.view_changed.connect(window.set_region)
+        window.show()
+        self.add_window(window)
+        return window
+
+    def add_window(self, window: QWidget):
+        """ Keep a window opened from this viewer until it is closed, when it is deleted (which disconnects it
+            from the viewer's signals).
+        """
+        window.setAttribute(Qt.WA_DeleteOnClose)
+        window.destroyed.connect(lambda: self.windows.remove(window) if window in self.windows else None)
+        self.windows.append(window)
+
+    # ------------------------------------------------
+    # Channels
+    # ------------------------------------------------
+
+    # default channel colors: green, magenta, cyan, red, blue, yellow
+    channel_colors = [(0, 255, 0), (255, 0, 255), (0, 255, 255), (255, 0, 0), (0, 0, 255), (255, 255, 0)]
+
+    def set_channels(self, arrays: list, colors: list = None):
+        """ Show channels as an additive composite. Number keys toggle channel visibility.
+        @param arrays: (height, width) data of each channel
+        @param colors: RGB color of each channel, None for the default colors.
+        """
+        colors = ImageViewer.channel_colors if colors is None else colors
+        self.scene.detach_shared()
+        self.scene.set_channels([Channel(x, colors[i % len(colors)]) for i, x in enumerate(arrays)])
+
+    def auto_contrast(self, in_view: bool = False):
+        """ Set the display window of each channel (or of the image) from the 0.1 and 99.9 percentiles of its values.
+        @param in_view: take the values from the part of the image in view, rather than the whole image.
+        """
+        region = self.view_region() if in_view else None
+        self.scene.auto_contrast(region)
+
+    def toggle_channel(self, index: int):
+        """ Show/hide a channel.
+        """
+        if self.scene.compositor is not None and index < len(self.scene.compositor.channels):
+            self.scene.set_channel_visible(index, not self.scene.compositor.channels[index].visible)
+
+    def set_labels(self, labels: np.ndarray, opacity: float = 0.5) -> LabelStatistics:
+        """ Overlay a label image; clicking a label highlights it.
+        @param labels: (height, width) uint16 or uint32 label image; 0 is background.
+        @param opacity: opacity of the overlay
+        @return: statistics of the labels (area, mean intensity, bounding box).
+        """
+        return self.scene.set_label_overlay(labels, opacity)
+
+    # ------------------------------------------------
+    # Stacks
+    # ------------------------------------------------
+
+    def set_stack(self, stack: np.ndarray, frame: int = 0):
+        """ Show a stack of frames.
+        @param stack: (frames, height, width) array, e.g. a numpy memmap of a file larger than memory.
+        @param frame: frame to show
+        @raise ValueError: if the stack isn't (frames, height, width), e.g. a stack of RGB frames.
+        """
+        if stack.ndim != 3:
+            raise ValueError('A stack must be a (frames, height, width) array, not {}.'.format(stack.shape))
+        self.stack = stack
+        self.stack_changed.emit(self.stack)
+        self.image_path = None
+        self.scene.detach_shared()
+        self.clear_tracking(len(stack))
+        self.set_frame(frame)
+        self.viewer.setSceneRect(self.scene.sceneRect())
+
+    def clear_tracking(self, n_frames: int = None):
+        """ Drop the per-frame offsets of tracked ROIs that don't fit a stack.
+        @param n_frames: number of frames of the stack, None if there is no stack (drops all).
+        """
+        for roi in self.scene.rois:
+            if roi.frame_offsets is not None and len(roi.frame_offsets) != n_frames:
+                roi.clear_tracking()
+
+    def load_stack(self, path: str, frame: int = 0):
+        """ Show a multi-page TIFF file as a stack. Frames are read from the file as they are shown.
+        @param path: TIFF file
+        @param frame: frame to show
+        """
+        self.set_stack(TiffStack(path), frame)
+        self.image_path = path
+
+    def attach_shared(self, name: str, shape: tuple, dtype, interval: int = 50) -> SharedArray:
+        """ Show an image or stack in a shared memory block of another process, without copying it.
+            Any number of viewer processes can attach to the block; each redraws when the producer marks the
+            array as changed.
+        @param name: block name
+        @param shape: (height, width) image or (frames, height, width) stack shape
+        @param dtype: array type
+        @param interval: interval at which to check for changes (ms)
+        @return: the shared array
+        """
+        if len(shape) == 2:
+            self.stack = None
+            self.stack_changed.emit(self.stack)
+            self.image_path = None
+            self.clear_tracking()
+            return self.scene.attach_shared(name, shape, dtype, interval)
+        shared = SharedArray.attach(name, shape, dtype)
+        self.set_stack(shared.array)
+        self.scene.watch_shared(shared, lambda: self.set_frame(self.frame), interval)
+        return shared
+
+    def set_frame(self, frame: int):
+        """ Show a frame of the stack.
+        """
+        if self.stack is None:
+            return
+        self.frame = min(max(frame, 0), self.stack.shape[0] - 1)
+        data = np.asarray(self.stack[self.frame])
+        if self.scene.compositor is not None and len(self.scene.compositor.channels) == 1:
+            # keep the display settings and filters of a displayed frame
+            self.scene.set_channel_data(0, data)
+        else:
+            self.scene.set_image(ImageScene.array_to_image(data), data)
+        for roi in self.scene.rois:
+            roi.move_to_frame(self.frame)
+        self.frame_changed.emit(self.frame)
+
+    def show_kymograph(self, roi: PathRoi = None, width: float = 1.0) -> 'ImageViewer':
+        """ Open a kymograph (time down, distance across) along a path ROI in a new viewer.
+        @param roi: path ROI. If None, the selected open path ROI (or the line ROI).
+        @param width: width of the line (pixels), averaged across.
+        @return: the new viewer, or None if there is no stack or path ROI.
+        """
+        if roi is None:
+            roi = self.selected_path_roi()
+        if self.stack is None or roi is None:
+            return None
+        x, y = roi.scene_points()
+        return self.open_viewer(kymograph(self.stack, x, y, width=width), 'Kymograph')
+
+    def show_projection(self, method: str = 'max') -> Job:
+        """ Project the stack over its frames in the background, with a progress dialog, and open the
+            projection in a new viewer.
+        @param method: 'max', 'min', 'mean', 'std' or 'median'
+        @return: the projection job, or None if there is no stack.
+        """
+        if self.stack is None:
+            return None
+        job = ProjectionJob(self.stack, method, self)
+        job.done.connect(lambda data: self.open_viewer(data, method.capitalize() + ' projection'))
+        self.run_job(job, method.capitalize() + ' projection...')
+        return job
+
+    def correct_drift(self, reference: int = None) -> Job:
+        """ Estimate the drift of each frame in the background and then show the stack corrected for it.
+            The correction is applied as frames are read, through the table of shifts; the stack is not rewritten.
+        @param reference: reference frame, None for the current frame.
+        @return: the drift estimation job, or None if there is no stack.
+        """
+        if self.stack is None:
+            return None
+        stack = self.stack
+        source = stack.stack if isinstance(stack, DriftCorrectedStack) else stack
+        job = DriftJob(source, self.frame if reference is None else reference, self)
+
+        def correct(shifts: np.ndarray):
+            # the shifts are of the stack shown when the job started, not of any shown since
+            if self.stack is stack:
+                self.set_stack(DriftCorrectedStack(source, shifts), self.frame)
+
+        job.done.connect(correct)
+        self.run_job(job, 'Drift correction...')
+        return job
+
+    def track_rois(self, rois: list = None, search_radius: int = 10) -> Job:
+        """ Track ROIs placed on the current frame through the stack, in the background.
+            Each ROI is given a table of per-frame offsets, and moves with the frame.
+        @param rois: ROIs to track, None for all ROIs on the scene.
+        @param search_radius: largest movement between consecutive frames (pixels)
+        @return: the tracking job, or None if there is no stack.
+        """
+        if self.stack is None:
+            return None
+        rois = list(self.scene.rois if rois is None else rois)
+        boxes = []
+        for roi in rois:
+            bounds = roi.scene_region().boundingRect()
+            boxes.append([bounds.top(), bounds.left(), bounds.height(), bounds.width()])
+        stack, reference = self.stack, self.frame
+        job = TrackingJob(stack, np.array(boxes), reference, search_radius, self)
+
+        def set_tracking(offsets: np.ndarray):
+            # the offsets are of the stack and frame tracked on, not of any shown since
+            if self.stack is not stack:
+                return
+            for i, roi in enumerate(rois):
+                roi.set_tracking(offsets[:, i], reference)
+
+        job.done.connect(set_tracking)
+        self.run_job(job, 'Tracking ROIs...')
+        return job
+
+    def run_job(self, job: Job, label: str = None):
+        """ Run a background job with a progress dialog that can cancel it.
+            If the job fails, the error is shown in the dialog (or in the status bar if there is no dialog).
+        @param job: job to run
+        @param label: label of the progress dialog, or None to run the job without a dialog.
+        """
+        if label is not None:
+            dialog = QProgressDialog(label, 'Cancel', 0, 100, self)
+            dialog.setMinimumDuration(500)
+            dialog.canceled.connect(job.cancel)
+            job.progress.connect(dialog.setValue)
+            job.finished.connect(dialog.reset)
+
+            def show_error(message: str):
+                # keep the dialog open after the job finishes, until closed
+                dialog.setAutoClose(False)
+                dialog.setLabelText('{} failed:\n{}'.format(label, message))
+                dialog.setCancelButtonText('Close')
+                dialog.show()
+
+            job.failed.connect(show_error)
+        else:
+            job.failed.connect(self.status_bar.showMessage)
+        job.finished.connect(lambda: self.jobs.remove(job))
+        self.jobs.append(job)
+        job.start()
+
+    def load_image(self, path: str, preview_size: int = 1024, decode: bool = True) -> bool:
+        """ Show an image file. A large image is first shown as a reduced preview, decoded at the reduced size
+            (which some formats, e.g. JPEG, do much faster than a full decode), while the full image is decoded
+            in the background; the full image then replaces the preview. ROIs are in full-size image coordinates
+            throughout.
+        @param path: image file
+        @param preview_size: largest width or height of the preview (pixels)
+        @param decode: decode the full image of a preview. If False, the caller decodes it and passes it to
+                       image_decoded.
+        @return: False if the file can't be read.
+        """
+        reader = QImageReader(path)
+        size = reader.size()
+        is_large = size.isValid() and max(size.width(), size.height()) > preview_size
+        if is_large:
+            reader.setScaledSize(size.scaled(preview_size, preview_size, Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            return False
+        self.image_path = path
+        self.stack = None
+        self.stack_changed.emit(self.stack)
+        self.clear_tracking()
+        self.scene.detach_shared()
+        self.scene.set_image(image, size=size if is_large else None, source_path=path)
+        self.viewer.setSceneRect(self.scene.sceneRect())
+        if is_large and decode:
+            job = ImageDecodeJob(path)
+            job.done.connect(lambda full: self.image_decoded(path, full))
+            self.run_job(job)
+        return True
+
+    def image_decoded(self, path: str, image: QImage):
+        """ Replace the preview of an image file by the full image (unless something else is shown by now).
+        """
+        if path == self.image_path and self.scene.is_preview():
+            self.scene.set_image(image, source_path=path)
+
+    # ------------------------------------------------
+    # Directory browsing
+    # ------------------------------------------------
+
+    def open_directory(self, directory: str, prefetch: int = 2) -> int:
+        """ Browse the image files of a directory, with a strip of thumbnails (click to show a file) and the
+            previous/next file keys (Page Up and Page Down). The files before and after the shown one are decoded
+            in advance.
+        @param directory: directory
+        @param prefetch: number of files decoded in advance in each direction
+        @return: number of image files
+        """
+        self.files = list_images(directory)
+        self.prefetch_count = prefetch
+        if self.decoder is None:
+            self.decoder = ImageDecoder(max_images=2 * prefetch + 2, parent=self)
+            self.decoder.image_ready.connect(self.image_decoded)
+            # shortcuts rather than keyPressEvent, as the view and the strip use these keys to scroll
+            for key, step in [(Qt.Key_PageUp, -1), (Qt.Key_PageDown, 1)]:
+                shortcut = QShortcut(QKeySequence(key), self, context=Qt.WidgetWithChildrenShortcut)
+                shortcut.activated.connect(lambda step=step: self.show_file(self.file_index + step))
+        if self.thumbnail_strip is not None:
+            self.layout().removeWidget(self.thumbnail_strip)
+            self.thumbnail_strip.deleteLater()
+        self.thumbnail_strip = ThumbnailStrip(ThumbnailModel(self.files, self.decoder), self)
+        self.thumbnail_strip.clicked.connect(lambda index: self.show_file(index.row()))
+        self.layout().insertWidget(self.layout().indexOf(self.status_bar), self.thumbnail_strip)
+        if self.files:
+            self.show_file(0)
+        return len(self.files)
+
+    def show_file(self, index: int):
+        """ Show a file of the directory being browsed: at once if it has been decoded in advance,
+            otherwise by a preview until it is decoded.
+        """
+        if not self.files:
+            return
+        self.file_index = min(max(index, 0), len(self.files) - 1)
+        path = self.files[self.file_index]
+        image = self.decoder.image(path)
+        if image is not None:
+            self.image_path = path
+            self.stack = None
+            self.stack_changed.emit(self.stack)
+            self.clear_tracking()
+            self.scene.detach_shared()
+            self.scene.set_image(image, source_path=path)
+            self.viewer.setSceneRect(self.scene.sceneRect())
+        else:
+            self.load_image(path, decode=False)
+        # decode this file (if it is a preview) and then its neighbours, nearest first
+        order = [self.file_index]
+        for step in range(1, self.prefetch_count + 1):
+            order += [self.file_index + step, self.file_index - step]
+        self.decoder.prefetch([self.files[x] for x in order if 0 <= x < len(self.files)])
+        self.thumbnail_strip.setCurrentIndex(self.thumbnail_strip.model().index(self.file_index))
+        self.setWindowTitle(path)
+
+    # ------------------------------------------------
+    # Opening of files
+    # ------------------------------------------------
+
+    def eventFilter(self, obj: QObject, event: QEvent):
+        """ Implementation of QObject::eventFilter()
+            Intercept drag-and-drop events before they are passed to the graphics view.
+            In response to the drop of files, opens them (see open_files).
+            Mouse moves (and leaving the view) update the pixel readout, and are passed on.
+
+        @param obj: the "watched object" that events are intercepted from (the view's viewport)
+        @param event: the event
+        @return: whether the event is accepted or rejected for further processing.
+        """
+        if event.type() == QEvent.Drop:
+            paths = [x.toLocalFile() for x in event.mimeData().urls() if x.isLocalFile()]
+            if paths:
+                event.acceptProposedAction()
+                self.open_files(paths)
+            return True
+        elif event.type() == QEvent.DragEnter or event.type() == QEvent.DragMove:
+            if event.mimeData().hasUrls():
+                event.acceptProposedAction()
+            return True
+        elif event.type() == QEvent.MouseMove:
+            self.hover_position = self.viewer.mapToScene(event.pos())
+            if not self.readout_timer.isActive():
+                self.readout_timer.start()
+        elif event.type() == QEvent.Leave:
+            self.hover_position = None
+            self.readout_timer.start()
+        return False
+
+    def update_readout(self):
+        """ Show the position and value(s) of the pixel under the mouse in the status bar.
+        """
+        values = None if self.hover_position is None else \
+            self.scene.pixel_values(self.hover_position.x(), self.hover_position.y())
+        if values is None:
+            self.status_bar.clearMessage()
+            return
+        text = ', '.join(ImageScene.format_value(x) for x in values)
+        self.status_bar.showMessage('x {}  y {}  {}{}'.format(
+            int(np.floor(self.hover_position.x())), int(np.floor(self.hover_position.y())),
+            'frame {}  '.format(self.frame) if self.stack is not None else '', text))
+
+    def open_files(self, paths: list):
+        """ Open files without blocking: decoding is done in the background, with a progress dialog that can
+            cancel it where it may take a while.
+            A directory is browsed. A single TIFF file is opened as a stack if it has several pages, and any other
+            single image file is shown at once by a preview. Several image files of the same size become a stack,
+            one frame per file; otherwise each file is opened in a viewer of its own.
+        @param paths: files (or a directory)
+        """
+        if len(paths) == 1 and os.path.isdir(paths[0]):
+            self.open_directory(paths[0])
+        elif len(paths) == 1 and paths[0].lower().endswith(('.tif', '.tiff')):
+            job = TiffStackJob(paths[0])
+            job.done.connect(lambda stack: self.tiff_opened(paths[0], stack))
+            self.run_job(job, 'Opening ' + os.path.basename(paths[0]))
+        elif len(paths) == 1:
+            self.load_image(paths[0])
+        else:
+            sizes = {(x.width(), x.height()) for x in (QImageReader(path).size() for path in paths)}
+            if len(sizes) == 1 and min(sizes.pop()) > 0:
+                job = FileStackJob(paths)
+                job.done.connect(self.set_stack)
+                self.run_job(job, 'Reading {} files'.format(len(paths)))
+            else:
+                for path in paths:
+                    viewer = ImageViewer.open(path)
+                    if viewer is not None:
+                        viewer.show()
+                        self.add_window(viewer)
+
+    def tiff_opened(self, path: str, stack: TiffStack):
+        """ Show a TIFF file that has been opened in the background: as a stack if it has several pages,
+            otherwise as an image.
+        """
+        if stack is not False and len(stack) > 1:
+            self.set_stack(stack)
+            self.image_path = path
+        else:
+            self.load_image(path)
+
+    def closeEvent(self, event: QCloseEvent):
+        """ Stop decoding files of a directory, and cancel the background jobs, waiting for them to stop since
+            their threads mustn't be destroyed with the viewer while they run.
+            Overrides QWidget::closeEvent
+        """
+        if self.decoder is not None:
+            self.decoder.shutdown()
+        for job in self.jobs:
+            job.cancel()
+        for job in list(self.jobs):
+            job.wait()
+        super().closeEvent(event)
+
+    @staticmethod
+    def open(path: str, preview_size: int = 1024, example_rois: bool = False) -> 'ImageViewer':
+        """ Open an image file in a new viewer, shown at once with a preview of the image (see load_image).
+        @param path: image file
+        @param preview_size: largest width or height of the preview (pixels)
+        @param example_rois: add example ROIs.
+        @return: the viewer, or None if the file can't be read.
+        """
+        viewer = ImageViewer(QImage(1, 1, QImage.Format_Grayscale8), example_rois=example_rois)
+        if not viewer.load_image(path, preview_size):
+            return None
+        viewer.setWindowTitle(path)
+        return viewer
+
+    # ------------------------------------------------
+    # Linked views
+    # ------------------------------------------------
+
+    def open_linked_view(self, link_view: bool = True) -> 'ImageViewer':
+        """ Open another view of this viewer's scene, e.g. to compare regions side by side.
+            The views share the scene: its image data, stack, cached pixmaps and tiles, and ROIs, so nothing is
+            copied; channel visibility and display windows are shared too. Each view may zoom and pan on its own
+            (each draws the pixmaps for its own zoom) or follow the other.
+        @param link_view: link the zoom and position of the views.
+        @return: the new viewer
+        """
+        viewer = ImageViewer(self.scene.image, example_rois=False, scene=self.scene)
+        viewer.stack = self.stack
+        viewer.frame = self.frame
+        viewer.line_roi = self.line_roi
+        viewer.image_path = self.image_path
+        # the views show the same stack and frame (connections to slots are dropped when either view is deleted)
+        for source, target in [(self, viewer), (viewer, self)]:
+            source.frame_changed.connect(target.follow_frame)
+            source.stack_changed.connect(target.follow_stack)
+        if link_view:
+            self.link_view(viewer)
+        viewer.setWindowTitle(self.windowTitle())
+        viewer.show()
+        viewer.follow_view(self)
+        self.add_window(viewer)
+        return viewer
+
+    def link_view(self, other: 'ImageViewer'):
+        """ Link the zoom and position of this view and another view of the same scene, both ways.
+        """
+        self.view_changed.connect(other.follow_linked_view)
+        other.view_changed.connect(self.follow_linked_view)
+
+    def follow_linked_view(self, region: QRectF):
+        """ Slot for a change to a linked view (the sender).
+        """
+        self.follow_view(self.sender())
+
+    def follow_view(self, source: 'ImageViewer'):
+        """ Zoom and position the view as another view (unless that view is itself following this one).
+        """
+        if source.is_following or self.is_following:
+            return
+        self.is_following = True
+        self.set_scale(source.scale)
+        self.viewer.centerOn(source.viewer.mapToScene(source.viewer.viewport().rect().center()))
+        self.is_following = False
+
+    def follow_frame(self, frame: int):
+        """ Slot for a frame shown by a linked viewer of the same scene (and stack).
+        """
+        self.frame = frame
+
+    def follow_stack(self, stack):
+        """ Slot for a stack set (or removed) by a linked viewer of the same scene.
+        """
+        self.stack = stack
+
+    # ------------------------------------------------
+    # Command server
+    # ------------------------------------------------
+
+    def listen(self, name: str = SERVER_NAME) -> ViewerServer:
+        """ Take commands from scripts on a local socket (see viewer_server.ViewerClient), e.g. to show arrays,
+            add ROIs and fetch measurements without starting a viewer on every run.
+        @param name: server name
+        @return: the server
+        """
+        self.server = ViewerServer(self, name)
+        return self.server
+
+    def clear_rois(self):
+        self.line_roi = None
+        self.scene.clear_rois()
+
+    def set_array(self, data: np.ndarray):
+        """ Show an array as the image.
+        @param data: (height, width) grayscale or (height, width, 3) RGB array. RGB data are measured by their
+                     gray values (see ImageScene.set_data).
+        """
+        self.stack = None
+        self.stack_changed.emit(self.stack)
+        self.image_path = None
+        self.clear_tracking()
+        self.scene.detach_shared()
+        self.scene.set_image(ImageScene.array_to_image(data), data)
+
+    def open_viewer(self, data: np.ndarray, title: str) -> 'ImageViewer':
+        """ Open an array (e.g. a result) in a new viewer.
+        @param data: (height, width) array
+        @param title: window title
+        @return: the new viewer
+        """
+        viewer = ImageViewer(ImageScene.array_to_image(data), data, example_rois=False)
+        viewer.setWindowTitle(title)
+        viewer.show()
+        self.add_window(viewer)
+        return viewer
+
+    # ------------------------------------------------
+    # ROI measurement
+    # ------------------------------------------------
+
+    def measure_rois(self, reducer: str = 'mean', rois: list = None) -> np.ndarray:
+        """ Reduce the pixel values within each ROI, for every frame of the stack (or the image).
+        @param reducer: 'mean', 'sum', 'min', 'max', 'std' or 'count'
+        @param rois: ROIs to measure, None for all ROIs on the scene.
+        @return: (frames, n_rois) array, or None while the image is a preview.
+        """
+        rois = self.scene.rois if rois is None else rois
+        if self.stack is None:
+            data = self.scene.image_array()
+            if data is None:
+                return None
+            return self.scene.roi_index_cache.index(rois, data.shape[:2]).reduce(data, reducer)[None, :]
+        roi_index = self.scene.roi_index_cache.index(rois, self.stack.shape[1:3])
+        # displacement of tracked ROIs from their tracking origin, where their pixels are indexed
+        roi_shifts = None
+        if any(roi.frame_offsets is not None for roi in rois):
+            roi_shifts = np.zeros((self.stack.shape[0], len(rois), 2), dtype=int)
+            for i, roi in enumerate(rois):
+                if roi.frame_offsets is not None:
+                    roi_shifts[:, i] = roi.frame_offsets
+        return roi_time_series(self.stack, roi_index, reducer, roi_shifts=roi_shifts)
+
+    # ------------------------------------------------
+    # Automatic ROI detection
+    # ------------------------------------------------
+
+    def detect_rois(self, roi_type: str = 'ellipse', threshold: float = None, min_area: float = 4,
+                    max_area: float = None) -> int:
+        """ Threshold the image, find its connected components and add an ROI for each.
+        @param roi_type: 'ellipse' (moment-matched ellipse), 'path' (outline) or 'point' (centroid).
+        @param threshold: pixels > threshold are foreground. If None, Otsu's threshold is used.
+        @param min_area: smallest object area to keep (pixels)
+        @param max_area: largest object area to keep (pixels), None for no limit.
+        @return: number of ROIs added (none while the image is a preview).
+        """
+        data = self.scene.image_array()
+        if data is None:
+            return 0
+        objects = detect_objects(data, threshold=threshold, min_area=min_area,
+                                 max_area=max_area)
+        rois = []
+        if roi_type == 'ellipse':
+            for x0, y0, width, height in objects.ellipse_fits():
+                rois.append(EllipseRoi(x0, y0, width, height))
+        elif roi_type == 'path':
+            for x, y in objects.outlines():
+                rois.append(PathRoi(x, y, is_closed=True, is_anchored=False))
+        elif roi_type == 'point':
+            size = 4
+            for x, y in zip(objects.centroid_x, objects.centroid_y):
+                rois.append(PointRoi(x - size / 2, y - size / 2, size=size))
+        else:
+            raise ValueError('Unknown ROI type: ' + roi_type)
+        # the shape constructors also offset the item position by the shape origin, so reset it:
+        # the ROI geometry is then in image coordinates.
+        for roi in rois:
+            roi.setPos(0, 0)
+            roi.set_to_scale(self.scale)
+        self.scene.add_rois(rois)
+        return len(rois)
+
 
 # main program
 if __name__ == '__main__':
@@ -0,0 +1,252 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Measurement of pixel values within ROIs, over single images and stacks of frames.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from PyQt5.QtCore import (
+    Qt,
+    QRect
+)
+from PyQt5.QtGui import (
+    QImage,
+    QPainter,
+    QPainterPath
+)
+
+from SelectionRoi import SelectionRoi
+
+
+# ------------------------------------------------
+# ROI pixel indices
+# ------------------------------------------------
+
+
+def region_pixels(region: QPainterPath, shape: tuple) -> np.ndarray:
+    """ Flat indices of the image pixels covered by a region.
+        The region is filled into a mask over its bounding box, so a pixel is covered if Qt's
+        (non-antialiased) fill covers it.
+    @param region: region in image coordinates
+    @param shape: (height, width) of the image
+    @return: sorted flat (row-major) pixel indices.
+    """
+    bounds = region.boundingRect().toAlignedRect().intersected(QRect(0, 0, shape[1], shape[0]))
+    if bounds.isEmpty():
+        return np.zeros(0, dtype=np.int64)
+    # fill region into a mask of its bounds
+    mask = QImage(bounds.width(), bounds.height(), QImage.Format_Grayscale8)
+    mask.fill(0)
+    painter = QPainter(mask)
+    painter.translate(-bounds.x(), -bounds.y())
+    painter.fillPath(region, Qt.white)
+    painter.end()
+    bits = mask.constBits()
+    bits.setsize(mask.bytesPerLine() * mask.height())
+    pixels = np.frombuffer(bits, dtype=np.uint8).reshape(mask.height(), mask.bytesPerLine())[:, :mask.width()]
+    rows, columns = np.nonzero(pixels)
+    return (rows + bounds.y()).astype(np.int64) * shape[1] + columns + bounds.x()
+
+
+class RoiIndex:
+    """ Pixels covered by a set of ROIs, in compressed sparse row form: the flat pixel indices of ROI i
+        are indices[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, indices: np.ndarray, offsets: np.ndarray, shape: tuple):
+        """
+        @param indices: concatenated flat pixel indices of all ROIs
+        @param offsets: start of each ROI's indices, plus the total length (n_rois + 1)
+        @param shape: (height, width) of the image the indices refer to
+        """
+        self.indices = indices
+        self.offsets = offsets
+        self.shape = tuple(shape)
+
+    @staticmethod
+    def from_rois(rois: list, shape: tuple) -> 'RoiIndex':
+        """ Pixel indices of ROIs on an image.
+        @param rois: ROIs (on a scene in image coordinates)
+        @param shape: (height, width) of the image
+        """
+        return RoiIndex.from_pixels([region_pixels(roi.scene_region(), shape) for roi in rois], shape)
+
+    @staticmethod
+    def from_pixels(pixels: list, shape: tuple) -> 'RoiIndex':
+        """ Combine the pixel indices of individual ROIs.
+        @param pixels: flat pixel indices of each ROI
+        @param shape: (height, width) of the image
+        """
+        offsets = np.zeros(len(pixels) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in pixels])
+        indices = np.concatenate(pixels) if pixels else np.zeros(0, dtype=np.int64)
+        return RoiIndex(indices, offsets, shape)
+
+    def counts(self) -> np.ndarray:
+        """ Number of pixels in each ROI.
+        """
+        return np.diff(self.offsets)
+
+    def shifted_indices(self, roi_shifts: np.ndarray) -> np.ndarray:
+        """ Pixel indices with each ROI displaced, frame by frame (clamped to the image edges).
+        @param roi_shifts: (frames, n_rois, 2) displacement (dy, dx) of each ROI in each frame
+        @return: (frames, n_pixels) flat pixel indices
+        """
+        pixel_roi = np.repeat(np.arange(len(self.offsets) - 1), self.counts())
+        rows, columns = np.divmod(self.indices, self.shape[1])
+        rows = np.clip(rows[None, :] + roi_shifts[:, pixel_roi, 0], 0, self.shape[0] - 1)
+        columns = np.clip(columns[None, :] + roi_shifts[:, pixel_roi, 1], 0, self.shape[1] - 1)
+        return rows * self.shape[1] + columns
+
+    def reduce(self, frames: np.ndarray, reducer: str = 'mean', roi_shifts: np.ndarray = None) -> np.ndarray:
+        """ Reduce the pixel values within each ROI, for one or more frames.
+            Each frame is a single gather of the ROI pixels followed by a segmented reduction. The gathered values
+            stay in the frame type; sums are accumulated in float64.
+        @param frames: (height, width) image or (frames, height, width) stack
+        @param reducer: 'mean', 'sum', 'min', 'max', 'std' or 'count'
+        @param roi_shifts: (frames, n_rois, 2) displacement (dy, dx) of each ROI in each frame
+                           (e.g. from tracking), or None.
+        @return: (n_rois,) or (frames, n_rois) array; NaN for ROIs with no pixels.
+        """
+        counts = self.counts()
+        is_single = frames.ndim == 2
+        flat = np.asarray(frames).reshape(1 if is_single else frames.shape[0], -1)
+        result = np.full((flat.shape[0], len(counts)), np.nan)
+        if reducer == 'count':
+            result[:] = counts
+        else:
+            # segmented reduction over the non-empty ROIs
+            filled = counts > 0
+            starts = self.offsets[:-1][filled]
+            if roi_shifts is None:
+                values = flat[:, self.indices]
+            else:
+                values = np.take_along_axis(flat, self.shifted_indices(roi_shifts), axis=1)
+            if reducer == 'sum':
+                result[:, filled] = np.add.reduceat(values, starts, axis=1, dtype=np.float64)
+            elif reducer == 'mean':
+                result[:, filled] = np.add.reduceat(values, starts, axis=1, dtype=np.float64) / counts[filled]
+            elif reducer == 'min':
+                result[:, filled] = np.minimum.reduceat(values, starts, axis=1)
+            elif reducer == 'max':
+                result[:, filled] = np.maximum.reduceat(values, starts, axis=1)
+            elif reducer == 'std':
+                mean = np.add.reduceat(values, starts, axis=1, dtype=np.float64) / counts[filled]
+                mean_square = np.add.reduceat(np.square(values, dtype=np.float64), starts, axis=1) / counts[filled]
+                result[:, filled] = np.sqrt(np.maximum(mean_square - mean**2, 0))
+            else:
+                raise ValueError('Unknown reducer: ' + reducer)
+        return result[0] if is_single else result
+
+
+class RoiIndexCache:
+    """ Cache of ROI pixel indices, so that a set of ROIs is rasterized once for any number of
+        measurements on images of the same shape.
+        Each ROI's pixels are cached separately, and an ROI's entry is dropped when its geometry
+        changes; combined indices of ROI sets are rebuilt from the per-ROI entries when needed.
+    """
+
+    def __init__(self):
+        # {roi: {shape: pixel indices}}
+        self.roi_pixels = {}
+        # {(rois, shape): RoiIndex}
+        self.roi_indexes = {}
+
+    def invalidate(self, roi: SelectionRoi):
+        """ Drop the cached pixels of an ROI (e.g. slot for a change in its geometry).
+        """
+        if self.roi_pixels.pop(roi, None) is not None:
+            self.roi_indexes = {key: value for key, value in self.roi_indexes.items() if roi not in key[0]}
+
+    def clear(self):
+        """ Drop all cached pixels.
+        """
+        self.roi_pixels.clear()
+        self.roi_indexes.clear()
+
+    def pixels(self, roi: SelectionRoi, shape: tuple) -> np.ndarray:
+        """ Flat pixel indices of an ROI on an image. Those of a tracked ROI are at its tracking origin, so they
+            stay valid as the ROI moves from frame to frame; the frame offsets are applied when measuring.
+        """
+        shape = tuple(shape)
+        shape_pixels = self.roi_pixels.setdefault(roi, {})
+        if shape not in shape_pixels:
+            shape_pixels[shape] = region_pixels(roi.tracking_region(), shape)
+        return shape_pixels[shape]
+
+    def index(self, rois: list, shape: tuple) -> RoiIndex:
+        """ Pixel indices of a set of ROIs on an image.
+        """
+        key = (tuple(rois), tuple(shape))
+        if key not in self.roi_indexes:
+            self.roi_indexes[key] = RoiIndex.from_pixels([self.pixels(roi, shape) for roi in rois], shape)
+        return self.roi_indexes[key]
+
+
+# ------------------------------------------------
+# Time series over stacks
+# ------------------------------------------------
+
+
+def _reduce_memmap_frames(file_name: str, dtype: np.dtype, shape: tuple, offset: int, start: int, stop: int,
+                          roi_index: RoiIndex, reducer: str, roi_shifts: np.ndarray) -> np.ndarray:
+    """ Process pool worker: reduce a chunk of frames of a memory-mapped stack.
+    """
+    stack = np.memmap(file_name, dtype=dtype, mode='r', shape=shape, offset=offset)
+    return roi_index.reduce(stack[start:stop], reducer, roi_shifts)
+
+
+def chunk_frame_count(stack: np.ndarray, roi_index: RoiIndex, reducer: str, is_shifted: bool,
+                      chunk_bytes: int) -> int:
+    """ Number of frames to reduce at once for chunks of about chunk_bytes: each frame costs its values as read,
+        its gathered ROI values, their float64 copy for sums (reduceat casts its whole input), and the shifted
+        pixel indices of tracked ROIs with their intermediates.
+    """
+    n_pixels = len(roi_index.indices)
+    pixel_bytes = stack.dtype.itemsize + (8 if reducer in ('sum', 'mean', 'std') else 0) + (32 if is_shifted else 0)
+    frame_bytes = int(np.prod(stack.shape[1:])) * stack.dtype.itemsize + n_pixels * pixel_bytes
+    return max(1, chunk_bytes // max(frame_bytes, 1))
+
+
+def roi_time_series(stack: np.ndarray, roi_index: RoiIndex, reducer: str = 'mean', chunk_bytes: int = 1 << 26,
+                    n_processes: int = None, roi_shifts: np.ndarray = None) -> np.ndarray:
+    """ Reduce the pixel values within each ROI for every frame of a stack.
+        Chunks of a file-backed stack (a numpy memmap of a whole file region) are shared among a process
+        pool, each process mapping the file itself. Other stacks are reduced chunk by chunk in this process,
+        as copying them to other processes would cost more than the reduction.
+    @param stack: (frames, height, width) stack
+    @param roi_index: ROI pixel indices for the frame shape
+    @param reducer: 'mean', 'sum', 'min', 'max', 'std' or 'count'
+    @param chunk_bytes: memory for the frames reduced at once (bytes; per process for a file-backed stack)
+    @param n_processes: process pool size, None for the number of CPUs.
+    @param roi_shifts: (frames, n_rois, 2) displacement (dy, dx) of each ROI in each frame, or None.
+    @return: (frames, n_rois) array
+    """
+    if tuple(stack.shape[1:]) != roi_index.shape:
+        raise ValueError('Stack frame shape does not match ROI index shape.')
+    chunk_frames = chunk_frame_count(stack, roi_index, reducer, roi_shifts is not None, chunk_bytes)
+    chunks = [(start, min(start + chunk_frames, stack.shape[0])) for start in range(0, stack.shape[0], chunk_frames)]
+    chunk_shifts = [None if roi_shifts is None else roi_shifts[start:stop] for start, stop in chunks]
+
+    is_file_backed = isinstance(stack, np.memmap) and isinstance(stack.base, mmap.mmap) and stack.filename
+    if is_file_backed and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_processes or os.cpu_count()) as pool:
+            futures = [pool.submit(_reduce_memmap_frames, stack.filename, stack.dtype, stack.shape, stack.offset,
+                                   start, stop, roi_index, reducer, shifts)
+                       for (start, stop), shifts in zip(chunks, chunk_shifts)]
+            results = [x.result() for x in futures]
+    else:
+        results = [roi_index.reduce(stack[start:stop], reducer, shifts)
+                   for (start, stop), shifts in zip(chunks, chunk_shifts)]
+
+    if not results:
+        return np.zeros((0, len(roi_index.counts())))
+    return np.concatenate(results)
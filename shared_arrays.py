@@ -0,0 +1,157 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Arrays in shared memory blocks, shared between an analysis process and viewer processes without copying,
+# with a change counter for notifications.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import sys
+from multiprocessing import (
+    resource_tracker,
+    shared_memory
+)
+
+import numpy as np
+
+from PyQt5.QtCore import (
+    QObject,
+    QTimer,
+    pyqtSignal
+)
+
+
+# names of the blocks created by this process (see SharedArray.create)
+_created_names = set()
+
+
+def _open_block(name: str) -> shared_memory.SharedMemory:
+    """ Attach to an existing shared memory block, without taking ownership of it: on POSIX the resource
+        tracker would otherwise unlink the block when this process exits, removing it from the producer.
+        The registration of a block created by this process is its owner's, so it is kept.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    block = shared_memory.SharedMemory(name=name)
+    if block.name not in _created_names:
+        try:
+            resource_tracker.unregister(block._name, 'shared_memory')
+        except (AttributeError, KeyError):
+            pass
+    return block
+
+
+class SharedArray:
+    """ numpy array in a shared memory block. The array is at the start of the block, so any block holding an
+        array (e.g. made by np.ndarray(shape, dtype, buffer=block.buf)) can be attached by its name, shape and type.
+        Changes are counted in a second, small block (named name + '_version') that the writer increments after
+        writing (mark_changed), so readers can poll it (see SharedArrayWatcher) instead of being sent messages.
+    """
+
+    def __init__(self, block: shared_memory.SharedMemory, shape: tuple, dtype, version_block=None,
+                 is_owner: bool = False):
+        """ Use create() or attach().
+        """
+        self.block = block
+        self.version_block = version_block
+        self.is_owner = is_owner
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.array = np.ndarray(self.shape, self.dtype, buffer=block.buf)
+        self.counter = None if version_block is None else np.ndarray((1,), np.uint64, buffer=version_block.buf)
+
+    @property
+    def name(self) -> str:
+        return self.block.name
+
+    @staticmethod
+    def create(shape: tuple, dtype, name: str = None) -> 'SharedArray':
+        """ Make a shared array (zeros), owned by this process, e.g. in a producer.
+        @param shape: array shape
+        @param dtype: array type
+        @param name: block name, None for a unique name.
+        """
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        block = shared_memory.SharedMemory(name=name, create=True, size=size)
+        version_block = shared_memory.SharedMemory(name=block.name + '_version', create=True, size=8)
+        _created_names.update([block.name, version_block.name])
+        shared = SharedArray(block, shape, dtype, version_block, is_owner=True)
+        shared.array[...] = 0
+        shared.counter[0] = 0
+        return shared
+
+    @staticmethod
+    def attach(name: str, shape: tuple, dtype) -> 'SharedArray':
+        """ Attach to the shared array of another process.
+        @param name: block name
+        @param shape: array shape
+        @param dtype: array type
+        @raise FileNotFoundError: if there is no such block.
+        """
+        block = _open_block(name)
+        if block.size < int(np.prod(shape)) * np.dtype(dtype).itemsize:
+            block.close()
+            raise ValueError('Shared memory block {} is smaller than the array.'.format(name))
+        try:
+            version_block = _open_block(name + '_version')
+        except FileNotFoundError:
+            version_block = None
+        return SharedArray(block, shape, dtype, version_block)
+
+    def version(self) -> int:
+        """ Number of changes marked so far (0 if the array has no change counter).
+        """
+        return 0 if self.counter is None else int(self.counter[0])
+
+    def mark_changed(self):
+        """ Mark the array as changed, after writing to it.
+        """
+        if self.counter is not None:
+            self.counter[0] += 1
+
+    def close(self):
+        """ Detach from the blocks; the owner also removes them. The array can't be used after this.
+        """
+        self.array = None
+        self.counter = None
+        for block in [self.block, self.version_block]:
+            if block is not None:
+                block.close()
+                if self.is_owner:
+                    block.unlink()
+                    _created_names.discard(block.name)
+
+
+class SharedArrayWatcher(QObject):
+    """ Polls the change counter of a shared array and emits changed when it has been incremented.
+        Reading the counter costs nothing, so it can be polled at frame rate; several writes between
+        polls give one notification.
+    """
+
+    changed = pyqtSignal()
+
+    def __init__(self, shared: SharedArray, interval: int = 50, parent: QObject = None):
+        """
+        @param shared: shared array
+        @param interval: polling interval (ms)
+        """
+        super().__init__(parent)
+        self.shared = shared
+        self.last_version = shared.version()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+        if shared.counter is not None:
+            self.timer.start(interval)
+
+    def poll(self):
+        """ Slot for timer.
+        """
+        version = self.shared.version()
+        if version != self.last_version:
+            self.last_version = version
+            self.changed.emit()
+
+    def stop(self):
+        self.timer.stop()
@@ -0,0 +1,214 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Random access to the pages of multi-page TIFF files, read as stacks of frames.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import mmap
+import re
+import struct
+import zlib
+
+import numpy as np
+
+from disk_cache import (
+    file_key,
+    load_array,
+    save_array
+)
+from image_analysis import rgb_to_gray
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+IMAGE_DESCRIPTION = 270
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+
+# numpy types of the TIFF field types (rationals are read as pairs of integers)
+FIELD_TYPES = {1: 'u1', 2: 'u1', 3: 'u2', 4: 'u4', 5: 'u4', 6: 'i1', 7: 'u1', 8: 'i2', 9: 'i4', 10: 'i4',
+               11: 'f4', 12: 'f8', 16: 'u8', 17: 'i8', 18: 'u8'}
+# numpy kinds of the sample formats: unsigned, signed, float
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class TiffStack:
+    """ Multi-page TIFF file as a (frames, height, width) stack, with pages read on demand.
+        The chain of image file directories (IFDs) is walked once to index the page offsets, and the index is
+        cached on disk by the file's path, size and modification time, so reopening the file, or reading any
+        frame, doesn't walk the chain again. The file is memory-mapped and uncompressed pages are returned as
+        views of the map (read-only); deflate-compressed pages are decompressed. All pages are assumed to have
+        the shape and type of the first. Pages of several samples per pixel (RGB) are read as their gray values
+        (see image_analysis.rgb_to_gray), as stacks hold one value per pixel.
+        Supports the indexing used on stacks: stack[frame], stack[start:stop] and
+        stack[start:stop, top:bottom, left:right].
+    """
+
+    def __init__(self, path: str, use_cache: bool = True):
+        """
+        @param path: TIFF file (classic or BigTIFF)
+        @param use_cache: use (and write) the cached page index.
+        """
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # header: byte order, then classic TIFF (42) or BigTIFF (43)
+        self.byte_order = {b'II': '<', b'MM': '>'}.get(self.map[:2])
+        if self.byte_order is None:
+            raise ValueError('Not a TIFF file: ' + path)
+        version = self.unpack('H', 2)
+        if version == 42:
+            self.offset_format, self.count_format, self.entry_size = 'I', 'H', 12
+            first_offset = self.unpack('I', 4)
+        elif version == 43:
+            self.offset_format, self.count_format, self.entry_size = 'Q', 'Q', 20
+            first_offset = self.unpack('Q', 8)
+        else:
+            raise ValueError('Not a TIFF file: ' + path)
+
+        # page offsets, from the cache or the IFD chain
+        key = file_key(path)
+        self.page_offsets = load_array('tiff_pages', key) if use_cache else None
+        if self.page_offsets is None:
+            self.page_offsets = self.read_page_offsets(first_offset)
+            if use_cache:
+                save_array('tiff_pages', key, self.page_offsets)
+
+        # frame shape and type from the first page
+        tags = self.read_tags(0)
+        samples = int(tags.get(SAMPLES_PER_PIXEL, [1])[0])
+        if TILE_WIDTH in tags:
+            raise ValueError('Tiled TIFF pages are not supported.')
+        if samples > 1 and tags.get(PLANAR_CONFIGURATION, [1])[0] != 1:
+            raise ValueError('Planar TIFF pages are not supported.')
+        bits = int(tags.get(BITS_PER_SAMPLE, [1])[0])
+        kind = SAMPLE_KINDS.get(int(tags.get(SAMPLE_FORMAT, [1])[0]))
+        if kind is None or bits not in (8, 16, 32, 64):
+            raise ValueError('Unsupported TIFF sample type.')
+        if int(tags.get(PREDICTOR, [1])[0]) not in (1, 2):
+            raise ValueError('Unsupported TIFF predictor: %d' % int(tags[PREDICTOR][0]))
+        self.file_dtype = np.dtype('%s%s%d' % (self.byte_order, kind, bits // 8))
+        self.samples = samples
+        frame_shape = (int(tags[IMAGE_LENGTH][0]), int(tags[IMAGE_WIDTH][0]))
+        self.frame_size = int(np.prod(frame_shape)) * samples
+
+        # ImageJ writes stacks larger than 4 GB with only the first IFD, followed by the frames back to back
+        self.contiguous_offset = None
+        description = bytes(tags.get(IMAGE_DESCRIPTION, b'')).decode('latin-1')
+        images = re.search(r'images=(\d+)', description)
+        if description.startswith('ImageJ=') and images and len(self.page_offsets) == 1 \
+                and tags.get(COMPRESSION, [1])[0] == 1:
+            self.contiguous_offset = int(tags[STRIP_OFFSETS][0])
+            n_frames = min(int(images.group(1)),
+                           (len(self.map) - self.contiguous_offset) // (self.frame_size * self.file_dtype.itemsize))
+        else:
+            n_frames = len(self.page_offsets)
+
+        self.shape = (n_frames,) + frame_shape
+        self.dtype = self.file_dtype.newbyteorder('=')
+        self.ndim = len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def unpack(self, field_format: str, offset: int):
+        """ Value of a field of the file.
+        """
+        return struct.unpack_from(self.byte_order + field_format, self.map, offset)[0]
+
+    def read_page_offsets(self, first_offset: int) -> np.ndarray:
+        """ Offsets of the IFDs of all pages, from the IFD chain. Only each IFD's entry count and
+            next-IFD offset are read.
+        """
+        count_size = struct.calcsize(self.count_format)
+        offsets = []
+        seen = set()
+        offset = first_offset
+        # stop at the end of the chain, or at an offset beyond the file or already seen (a corrupt chain)
+        while offset and offset < len(self.map) and offset not in seen:
+            offsets.append(offset)
+            seen.add(offset)
+            count = self.unpack(self.count_format, offset)
+            offset = self.unpack(self.offset_format, offset + count_size + count * self.entry_size)
+        return np.array(offsets, dtype=np.int64)
+
+    def read_tags(self, page: int) -> dict:
+        """ Tags of a page.
+        @return: {tag: values (array, or bytes for ASCII values)}
+        """
+        offset = int(self.page_offsets[page])
+        offset_size = struct.calcsize(self.offset_format)
+        count = self.unpack(self.count_format, offset)
+        tags = {}
+        for entry in range(offset + struct.calcsize(self.count_format),
+                           offset + struct.calcsize(self.count_format) + count * self.entry_size, self.entry_size):
+            tag, field_type = struct.unpack_from(self.byte_order + 'HH', self.map, entry)
+            if field_type not in FIELD_TYPES:
+                continue
+            n_values = self.unpack(self.offset_format, entry + 4) * (2 if field_type in (5, 10) else 1)
+            dtype = np.dtype(self.byte_order + FIELD_TYPES[field_type])
+            # values are within the entry if they fit, otherwise at an offset
+            value_offset = entry + 4 + offset_size
+            if n_values * dtype.itemsize > offset_size:
+                value_offset = self.unpack(self.offset_format, value_offset)
+            values = np.frombuffer(self.map, dtype=dtype, count=n_values, offset=value_offset)
+            tags[tag] = values.tobytes().rstrip(b'\0') if field_type == 2 else values
+        return tags
+
+    def frame(self, index: int) -> np.ndarray:
+        """ Values of a frame. Uncompressed frames are views of the memory-mapped file, if in native byte order.
+        """
+        if self.contiguous_offset is not None:
+            offset = self.contiguous_offset + index * self.frame_size * self.file_dtype.itemsize
+            return self.native(np.frombuffer(self.map, self.file_dtype, self.frame_size, offset))
+
+        tags = self.read_tags(index)
+        strip_offsets = tags[STRIP_OFFSETS].astype(np.int64)
+        strip_byte_counts = tags[STRIP_BYTE_COUNTS].astype(np.int64)
+        compression = int(tags.get(COMPRESSION, [1])[0])
+        if compression == 1:
+            if np.all(strip_offsets[1:] == strip_offsets[:-1] + strip_byte_counts[:-1]):
+                values = np.frombuffer(self.map, self.file_dtype, self.frame_size, int(strip_offsets[0]))
+            else:
+                data = b''.join(self.map[x:x + n] for x, n in zip(strip_offsets, strip_byte_counts))
+                values = np.frombuffer(data, self.file_dtype, self.frame_size)
+        elif compression in (8, 32946):
+            data = b''.join(zlib.decompress(self.map[x:x + n]) for x, n in zip(strip_offsets, strip_byte_counts))
+            values = np.frombuffer(data, self.file_dtype, self.frame_size)
+            predictor = int(tags.get(PREDICTOR, [1])[0])
+            if predictor == 2:
+                # horizontal differencing: each sample is stored as the difference from the previous one in the row
+                values = values.reshape(self.shape[1], self.shape[2], -1)
+                values = np.cumsum(values, axis=1, dtype=values.dtype)
+            elif predictor != 1:
+                raise ValueError('Unsupported TIFF predictor: %d' % predictor)
+        else:
+            raise ValueError('Unsupported TIFF compression: %d' % compression)
+        return self.native(values)
+
+    def native(self, values: np.ndarray) -> np.ndarray:
+        """ Frame values in the frame shape and native byte order (gray values, if the pixels have several samples).
+        """
+        if self.samples > 1:
+            values = values.reshape(self.shape[1:] + (self.samples,))
+            values = rgb_to_gray(values[..., :3]) if self.samples >= 3 else values[..., 0]
+        values = values.reshape(self.shape[1:])
+        return values if values.dtype == self.dtype else values.astype(self.dtype)
+
+    def __getitem__(self, key):
+        keys = key if isinstance(key, tuple) else (key,)
+        if isinstance(keys[0], slice):
+            frames = range(self.shape[0])[keys[0]]
+            return np.stack([self.frame(x)[keys[1:]] for x in frames]) if len(frames) \
+                else np.zeros((0,) + np.empty(self.shape[1:], dtype=self.dtype)[keys[1:]].shape, dtype=self.dtype)
+        return self.frame(range(self.shape[0])[keys[0]])[keys[1:]]
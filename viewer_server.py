@@ -0,0 +1,307 @@
+# ----------------------------------------------------------------------------------------------------
+######################################################################################################
+# Command server of a running image viewer, on a local socket, and a client for analysis scripts: show arrays
+# and files, add ROIs, set the frame, fetch ROI measurements.
+
+# Sean Parsons, September 2019
+######################################################################################################
+# ----------------------------------------------------------------------------------------------------
+
+
+import json
+import os
+
+import numpy as np
+
+from PyQt5.QtCore import (
+    QObject,
+    pyqtSignal
+)
+from PyQt5.QtNetwork import (
+    QLocalServer,
+    QLocalSocket
+)
+
+from SelectionRoi import (
+    PointRoi,
+    PathRoi,
+    RectangleRoi,
+    EllipseRoi
+)
+from shared_arrays import SharedArray
+
+# default server name
+SERVER_NAME = 'image_viewer'
+
+
+def encode_message(message: dict) -> bytes:
+    """ A message as sent on the socket: JSON, one message per line.
+    """
+    return json.dumps(message).encode() + b'\n'
+
+
+def npy_path(path: str) -> str:
+    """ Path of a .npy file, as np.save writes it (with the .npy suffix added if the path doesn't have it).
+    """
+    return path if path.endswith('.npy') else path + '.npy'
+
+
+def number(value) -> float:
+    """ A number of a command.
+    @raise ValueError: if the value isn't a number.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('Not a number: {!r}'.format(value))
+    return float(value)
+
+
+def make_roi(spec: dict):
+    """ ROI of a description, in image coordinates.
+    @param spec: {'type': 'rectangle' or 'ellipse', 'x', 'y', 'width', 'height'} (bounding box),
+                 {'type': 'path', 'x': [...], 'y': [...], 'closed': bool} or {'type': 'point', 'x', 'y', 'size'}
+                 (centre)
+    @raise ValueError: if the description isn't of an ROI.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('Not an ROI description: {!r}'.format(spec))
+    roi_type = spec.get('type')
+    try:
+        if roi_type == 'rectangle':
+            roi = RectangleRoi(*[number(spec[x]) for x in ['x', 'y', 'width', 'height']])
+        elif roi_type == 'ellipse':
+            roi = EllipseRoi(*[number(spec[x]) for x in ['x', 'y', 'width', 'height']])
+        elif roi_type == 'path':
+            if not isinstance(spec['x'], list) or not isinstance(spec['y'], list):
+                raise ValueError('The x and y of a path ROI must be lists.')
+            x, y = [number(v) for v in spec['x']], [number(v) for v in spec['y']]
+            if len(x) == 0 or len(x) != len(y):
+                raise ValueError('A path ROI needs at least one point, and as many x as y values.')
+            roi = PathRoi(x, y, is_closed=bool(spec.get('closed', False)), is_anchored=False)
+        elif roi_type == 'point':
+            x, y, size = number(spec['x']), number(spec['y']), number(spec.get('size', 4))
+            roi = PointRoi(x - size / 2, y - size / 2, size=size)
+        else:
+            raise ValueError('Unknown ROI type: {}'.format(roi_type))
+    except KeyError as error:
+        raise ValueError('{} ROI without {}'.format(roi_type, error))
+    # the shape constructors also offset the item position by the shape origin, so reset it
+    roi.setPos(0, 0)
+    return roi
+
+
+class ViewerServer(QObject):
+    """ Listens on a local socket (a named pipe on Windows) for commands to a viewer, so that scripts can drive a
+        running viewer rather than start one (and reload the image) on every run.
+        Commands and replies are JSON objects, one per line. Bulk data are not sent on the socket: arrays are
+        passed by shared memory block (see SharedArray) or by file, and measurements are returned in the reply
+        or written to a file.
+
+        {'command': 'show', 'shared': name, 'shape': [...], 'dtype': 'uint16'}  show a shared array (image or stack)
+        {'command': 'show', 'path': file}                   show a .npy file (memory-mapped) or an image/TIFF file;
+                                                            a (height, width, 3) array is an RGB image, any other
+                                                            3D array a stack
+        {'command': 'add_rois', 'rois': [...], 'clear': bool}   add ROIs (see make_roi)
+        {'command': 'set_frame', 'frame': n}                show a frame of the stack
+        {'command': 'measure', 'reducer': 'mean', 'path': file}   measure the ROIs in every frame; the
+                                                            (frames, n_rois) values are written to the .npy file
+                                                            if given, otherwise returned as 'values'
+        Replies are {'ok': true, ...} or {'error': message}.
+    """
+
+    # emitted with each command received
+    command_received = pyqtSignal(dict)
+
+    def __init__(self, viewer, name: str = SERVER_NAME):
+        """
+        @param viewer: image_viewer6.ImageViewer to drive
+        @param name: server name
+        @raise OSError: if the server can't listen (e.g. the name is in use by another viewer).
+        """
+        super().__init__(viewer)
+        self.viewer = viewer
+        self.server = QLocalServer(self)
+        # a viewer that crashed leaves its socket file behind on Unix: remove it, unless a viewer answers on it
+        socket = QLocalSocket()
+        socket.connectToServer(name)
+        if socket.waitForConnected(1000):
+            socket.disconnectFromServer()
+            raise OSError('Viewer server {} is in use by another viewer.'.format(name))
+        QLocalServer.removeServer(name)
+        if not self.server.listen(name):
+            raise OSError('Viewer server {} can\'t listen: {}'.format(name, self.server.errorString()))
+        self.server.newConnection.connect(self.connect_client)
+        # received data of each client not yet ending in a newline, {socket: bytes}
+        self.buffers = {}
+
+    def connect_client(self):
+        """ Slot for a new connection.
+        """
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            self.buffers[socket] = b''
+            socket.readyRead.connect(lambda socket=socket: self.read_commands(socket))
+            socket.disconnected.connect(lambda socket=socket: self.disconnect_client(socket))
+
+    def disconnect_client(self, socket: QLocalSocket):
+        self.buffers.pop(socket, None)
+        socket.deleteLater()
+
+    def read_commands(self, socket: QLocalSocket):
+        """ Slot for data from a client: run each complete command and reply.
+        """
+        *lines, self.buffers[socket] = (self.buffers.get(socket, b'') + bytes(socket.readAll())).split(b'\n')
+        for line in lines:
+            if line.strip():
+                socket.write(encode_message(self.run_command(line)))
+        socket.flush()
+
+    def run_command(self, line: bytes) -> dict:
+        """ Run a command.
+        @param line: JSON command
+        @return: reply
+        """
+        try:
+            command = json.loads(line)
+            self.command_received.emit(command)
+            name = command.get('command')
+            if name == 'show':
+                return self.show(command)
+            elif name == 'add_rois':
+                if command.get('clear', False):
+                    self.viewer.clear_rois()
+                rois = [make_roi(x) for x in command.get('rois', [])]
+                for roi in rois:
+                    roi.set_to_scale(self.viewer.scale)
+                self.viewer.scene.add_rois(rois)
+                return {'ok': True, 'n_rois': len(self.viewer.scene.rois)}
+            elif name == 'set_frame':
+                self.viewer.set_frame(int(command['frame']))
+                return {'ok': True, 'frame': self.viewer.frame}
+            elif name == 'measure':
+                values = self.viewer.measure_rois(command.get('reducer', 'mean'))
+                if values is None:
+                    raise ValueError('The image is still being decoded.')
+                if 'path' in command:
+                    path = npy_path(command['path'])
+                    np.save(path, values)
+                    return {'ok': True, 'path': path, 'shape': list(values.shape)}
+                return {'ok': True, 'values': values.tolist()}
+            raise ValueError('Unknown command: {}'.format(name))
+        except Exception as error:
+            # any failure is the client's to report, not the viewer's
+            return {'error': '{}: {}'.format(type(error).__name__, error)}
+
+    def show(self, command: dict) -> dict:
+        """ Run a show command.
+        """
+        if 'shared' in command:
+            shared = self.viewer.attach_shared(command['shared'], tuple(command['shape']), command['dtype'])
+            return {'ok': True, 'shape': list(shared.shape)}
+        path = command['path']
+        if path.lower().endswith('.npy'):
+            data = np.load(path, mmap_mode='r')
+            if data.ndim == 2 or (data.ndim == 3 and data.shape[2] == 3):
+                self.viewer.set_array(data)
+            elif data.ndim == 3:
+                self.viewer.set_stack(data)
+            else:
+                raise ValueError('{} is not an image, RGB image or stack: {}'.format(path, data.shape))
+            return {'ok': True, 'shape': list(data.shape)}
+        if not os.path.exists(path):
+            raise OSError('No such file: ' + path)
+        # decoded in the background
+        self.viewer.open_files([path])
+        return {'ok': True}
+
+
+class ViewerClient:
+    """ Client of a viewer server, for scripts; blocks until each command has been run.
+        Arrays are shown through shared memory blocks owned by the client, which stay shown (and can be
+        updated in place) until the client is closed.
+    """
+
+    def __init__(self, name: str = SERVER_NAME, timeout: int = 5000):
+        """
+        @param name: server name
+        @param timeout: time to wait for connection and for each reply (ms)
+        @raise OSError: if there is no server.
+        """
+        self.timeout = timeout
+        self.socket = QLocalSocket()
+        self.socket.connectToServer(name)
+        if not self.socket.waitForConnected(timeout):
+            raise OSError('No viewer server {}: {}'.format(name, self.socket.errorString()))
+        self.buffer = b''
+        # shared arrays shown, {name: SharedArray}
+        self.arrays = {}
+
+    def send(self, command: dict) -> dict:
+        """ Send a command and wait for its reply.
+        @raise OSError: if there is no reply.
+        @raise RuntimeError: if the command failed.
+        """
+        self.socket.write(encode_message(command))
+        self.socket.waitForBytesWritten(self.timeout)
+        while b'\n' not in self.buffer:
+            if not self.socket.waitForReadyRead(self.timeout):
+                raise OSError('No reply from viewer: ' + self.socket.errorString())
+            self.buffer += bytes(self.socket.readAll())
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def show_array(self, array: np.ndarray) -> SharedArray:
+        """ Show an image or stack: the array is copied once, into a shared memory block that the viewer attaches to.
+        @param array: (height, width) image or (frames, height, width) stack
+        @return: the shared array. Write to its array then call mark_changed() to update the viewer.
+        """
+        shared = SharedArray.create(array.shape, array.dtype)
+        shared.array[...] = array
+        self.arrays[shared.name] = shared
+        self.show_shared(shared)
+        return shared
+
+    def show_shared(self, shared: SharedArray) -> dict:
+        """ Show a shared array that the caller keeps up to date.
+        """
+        return self.send({'command': 'show', 'shared': shared.name, 'shape': list(shared.shape),
+                          'dtype': shared.dtype.str})
+
+    def show_file(self, path: str) -> dict:
+        """ Show a .npy file (memory-mapped) or an image/TIFF file.
+        """
+        return self.send({'command': 'show', 'path': os.path.abspath(path)})
+
+    def add_rois(self, rois: list, clear: bool = False) -> int:
+        """ Add ROIs (see make_roi).
+        @param clear: remove the ROIs on the viewer first.
+        @return: number of ROIs on the viewer
+        """
+        return self.send({'command': 'add_rois', 'rois': rois, 'clear': clear})['n_rois']
+
+    def set_frame(self, frame: int) -> int:
+        """ Show a frame of the stack.
+        @return: the frame shown
+        """
+        return self.send({'command': 'set_frame', 'frame': frame})['frame']
+
+    def measure(self, reducer: str = 'mean', path: str = None) -> np.ndarray:
+        """ Measure the ROIs in every frame.
+        @param reducer: 'mean', 'sum', 'min', 'max', 'std' or 'count'
+        @param path: .npy file through which to pass the values (for large results; the .npy suffix is added if
+                     missing), None to pass them on the socket.
+        @return: (frames, n_rois) array
+        """
+        if path is None:
+            return np.array(self.send({'command': 'measure', 'reducer': reducer})['values'])
+        return np.load(self.send({'command': 'measure', 'reducer': reducer, 'path': os.path.abspath(path)})['path'])
+
+    def close(self):
+        """ Disconnect, and remove the shared arrays.
+        """
+        self.socket.disconnectFromServer()
+        for shared in self.arrays.values():
+            shared.close()
+        self.arrays = {}